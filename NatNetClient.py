@@ -3,9 +3,14 @@ This file was taken from the NatNet SDK and modified slightly.
 NatNet Version 2.10.0 (06/15/2016)
 '''
 
+import json
+import os
 import socket
 import struct
-from threading import Thread, Lock
+from collections import deque
+from concurrent.futures import Future
+from threading import Thread, Lock, Event
+from time import time, perf_counter
 
 def trace( *args ):
     pass #print( "".join(map(str,args)) )
@@ -16,6 +21,12 @@ Quaternion = struct.Struct( '<ffff' )
 FloatValue = struct.Struct( '<f' )
 DoubleValue = struct.Struct( '<d' )
 
+# Marker classes that can be subscribed to, see NatNetClient.setSubscription
+MARKER_CLASSES = ( 'labeled', 'unlabeled' )
+
+# Marker classes kept without a subscription, the marker list only ever had the unlabeled markers
+DEFAULT_MARKER_CLASSES = ( 'unlabeled', )
+
 class NatNetClient:
     def __init__( self, ip_address="127.0.0.1", multicast_address="239.255.42.99", cmd_port=1510, data_port=1511):
         # Change this value to the IP address of the NatNet server.
@@ -38,20 +49,73 @@ class NatNetClient:
 
         # Set this to a callback method of your choice to receive per-rigid-body data descriptions.
         self.rigidBodyDictDescriptionListener = None
+
+        # Set this to a callback method of your choice to be told when the model definitions change.
+        # It is called with the new model definition version and the list of rigid body descriptions.
+        self.modelDefListener = None
+
+        # Set this to a file path to cache the last received model definitions on disk.
+        self.modelDefCachePath = None
+
+        # Set this to a filter (see filters.Pose_Filter) to add filtered poses to the rigid bodies of each frame.
+        self.poseFilter = None
+
+        # Set this to a callback method of your choice to receive NAT_MESSAGESTRING messages from the server.
+        self.messageListener = None
+
+        # Set this to the IP address the server streams from to drop data packets of other servers
+        # sharing the data port and multicast group. That is the interface selected in Motive's
+        # streaming settings, which is not 127.0.0.1 even when Motive runs on this machine.
+        self.dataSourceAddress = None
         
         # NatNet stream version. This will be updated to the actual version the server is using during initialization.
         self.__natNetStreamVersion = (3,0,0,0)
+        # Set by the first ping reply after run(). Later replies don't change the version,
+        # which decides how the data packets are unpacked.
+        self.__natNetStreamVersionKnown = False
 
         # List of rigid bodies
         self.rigidBodyDescription = []
         self.rigidBodyList = []
 
+        # Rigid bodies by id, rebuilt together with rigidBodyList
+        self.rigidBodyIndex = {}
+
+        # Incremented every time the server sends model definitions that differ from the current ones
+        self.modelDefVersion = 0
+
+        # Time the last NAT_REQUEST_MODELDEF was sent after the tracked models changed, None if not pending
+        self.__modelDefRequestTime = None
+
         # List of markers
         self.markerList = []
 
+        # Rigid bodies updated by the frame being unpacked
+        self.__frameRigidBodies = []
+
+        # Subscription, see setSubscription. The subscribed rigid body ids are
+        # resolved from the ids and names every time the model definitions change.
+        self.__subscription = None
+        self.__subscribedIds = None
+        self.__subscribedMarkers = DEFAULT_MARKER_CLASSES
+        self.__subscribedSkeletons = True
+
         # Lock for Client
         self._lock = Lock()
 
+        # Readiness signals, set once the first model definition / frame of data arrives.
+        self.modelDefReceived = Event()
+        self.frameReceived = Event()
+
+        # Requests waiting for a reply, by the message id of the reply, oldest first.
+        # Each entry is [future, send time, deadline].
+        self.__pendingRequests = {}
+        self.__requestLock = Lock()
+
+        # Round trip times of the periodic pings in seconds
+        self.__latency = { 'last': None, 'min': None, 'max': None, 'mean': None, 'count': 0, 'lost': 0 }
+        self.__pingStop = Event()
+
     # Client/server message ids
     NAT_PING                  = 0 
     NAT_PINGRESPONSE          = 1
@@ -87,8 +151,6 @@ class NatNetClient:
 
     # Unpack a rigid body object from a data packet
     def __unpackRigidBody( self, data ):
-        rigidBody = {}
-        
         offset = 0
 
         # ID (4 bytes)
@@ -96,11 +158,8 @@ class NatNetClient:
         offset += 4
         trace( "ID:", id )
 
-        for rb in self.rigidBodyList:
-            if rb['id'] == id:
-                rigidBody = rb
-                break
-                
+        rigidBody = self.rigidBodyIndex.get( id )
+
         # Position and orientation
         pos = Vector3.unpack( data[offset:offset+12] )
         offset += 12
@@ -112,6 +171,7 @@ class NatNetClient:
         if rigidBody is not None:
             rigidBody['position'] = pos
             rigidBody['rotation'] = rot
+            self.__frameRigidBodies.append( rigidBody )
 
         # Marker count (4 bytes)
         markerCount = int.from_bytes( data[offset:offset+4], byteorder='little' )
@@ -164,6 +224,9 @@ class NatNetClient:
             offset += 4
             trace( "\tMarker Error:", markerError )
 
+            if rigidBody is not None:
+                rigidBody['markerError'] = markerError
+
         # Version 2.6 and later
         if( ( ( self.__natNetStreamVersion[0] == 2 ) and ( self.__natNetStreamVersion[1] >= 6 ) ) or self.__natNetStreamVersion[0] > 2 or self.__natNetStreamVersion[0] == 0 ):
             param, = struct.unpack( 'h', data[offset:offset+2] )
@@ -176,6 +239,22 @@ class NatNetClient:
         
         return offset
 
+    # Size of a rigid body object in a data packet, matching what __unpackRigidBody reads
+    def __rigidBodySize( self, data, offset ):
+        # ID, position and orientation come before the marker count
+        markerCount = int.from_bytes( data[offset+32:offset+36], byteorder='little' )
+        size = 36 + markerCount * 12
+
+        # Marker ID's, sizes and the mean marker error
+        if( self.__natNetStreamVersion[0] >= 2 ):
+            size += markerCount * 8 + 4
+
+        # Tracking valid parameter
+        if( ( ( self.__natNetStreamVersion[0] == 2 ) and ( self.__natNetStreamVersion[1] >= 6 ) ) or self.__natNetStreamVersion[0] > 2 or self.__natNetStreamVersion[0] == 0 ):
+            size += 2
+
+        return size
+
     # Unpack a skeleton object from a data packet
     def __unpackSkeleton( self, data ):
         offset = 0
@@ -188,7 +267,10 @@ class NatNetClient:
         offset += 4
         trace( "Rigid Body Count:", rigidBodyCount )
         for j in range( 0, rigidBodyCount ):
-            offset += self.__unpackRigidBody( data[offset:] )
+            if self.__subscribedSkeletons:
+                offset += self.__unpackRigidBody( data[offset:] )
+            else:
+                offset += self.__rigidBodySize( data, offset )
 
         return offset
 
@@ -199,6 +281,7 @@ class NatNetClient:
         data = memoryview( data )
         offset = 0
         self.markerList = []
+        self.__frameRigidBodies = []
         
         # Frame number (4 bytes)
         frameNumber = int.from_bytes( data[offset:offset+4], byteorder='little' )
@@ -221,17 +304,21 @@ class NatNetClient:
             offset += 4
             trace( "Marker Count:", markerCount )
 
-            for j in range( 0, markerCount ):
-                pos = Vector3.unpack( data[offset:offset+12] )
-                offset += 12
-                #trace( "\tMarker", j, ":", pos[0],",", pos[1],",", pos[2] )
+            # The marker set positions aren't kept
+            offset += markerCount * 12
                  
         # Unlabeled markers count (4 bytes)
         unlabeledMarkersCount = int.from_bytes( data[offset:offset+4], byteorder='little' )
         offset += 4
         trace( "Unlabeled Markers Count:", unlabeledMarkersCount )
 
-        for i in range( 0, unlabeledMarkersCount ):
+        if 'unlabeled' not in self.__subscribedMarkers:
+            offset += unlabeledMarkersCount * 12
+            unlabeledMarkersCountRange = range( 0 )
+        else:
+            unlabeledMarkersCountRange = range( 0, unlabeledMarkersCount )
+
+        for i in unlabeledMarkersCountRange:
             marker = {}
             marker['labeled'] = False
             pos = Vector3.unpack( data[offset:offset+12] )
@@ -245,8 +332,13 @@ class NatNetClient:
         offset += 4
         trace( "Rigid Body Count:", rigidBodyCount )
 
+        subscribedIds = self.__subscribedIds
         for i in range( 0, rigidBodyCount ):
-            offset += self.__unpackRigidBody( data[offset:] )
+            # Step over the rigid bodies nobody subscribed to
+            if subscribedIds is not None and int.from_bytes( data[offset:offset+4], byteorder='little' ) not in subscribedIds:
+                offset += self.__rigidBodySize( data, offset )
+            else:
+                offset += self.__unpackRigidBody( data[offset:] )
 
         # Version 2.1 and later
         skeletonCount = 0
@@ -263,7 +355,15 @@ class NatNetClient:
             labeledMarkerCount = int.from_bytes( data[offset:offset+4], byteorder='little' )
             offset += 4
             trace( "Labeled Marker Count:", labeledMarkerCount )
-            for i in range( 0, labeledMarkerCount ):
+            if 'labeled' not in self.__subscribedMarkers:
+                labeledMarkerSize = 20
+                if( ( self.__natNetStreamVersion[0] == 2 and self.__natNetStreamVersion[1] >= 6 ) or self.__natNetStreamVersion[0] > 2 or self.__natNetStreamVersion[0] == 0 ):
+                    labeledMarkerSize += 2
+                offset += labeledMarkerCount * labeledMarkerSize
+                labeledMarkerCountRange = range( 0 )
+            else:
+                labeledMarkerCountRange = range( 0, labeledMarkerCount )
+            for i in labeledMarkerCountRange:
                 marker = {}
                 marker['labeled'] = True
                 id = int.from_bytes( data[offset:offset+4], byteorder='little' )
@@ -277,13 +377,15 @@ class NatNetClient:
                 offset += 4
 
                 # Version 2.6 and later
-                if( ( self.__natNetStreamVersion[0] == 2 and self.__natNetStreamVersion[1] >= 6 ) or self.__natNetStreamVersion[0] > 2 or major == 0 ):
+                if( ( self.__natNetStreamVersion[0] == 2 and self.__natNetStreamVersion[1] >= 6 ) or self.__natNetStreamVersion[0] > 2 or self.__natNetStreamVersion[0] == 0 ):
                     param, = struct.unpack( 'h', data[offset:offset+2] )
                     offset += 2
                     occluded = ( param & 0x01 ) != 0
                     pointCloudSolved = ( param & 0x02 ) != 0
                     modelSolved = ( param & 0x04 ) != 0
 
+                self.markerList.append(marker)
+
         # Force Plate data (version 2.9 and later)
         if( ( self.__natNetStreamVersion[0] == 2 and self.__natNetStreamVersion[1] >= 9 ) or self.__natNetStreamVersion[0] > 2 ):
             forcePlateCount = int.from_bytes( data[offset:offset+4], byteorder='little' )
@@ -333,6 +435,16 @@ class NatNetClient:
         trackedModelsChanged = ( param & 0x02 ) != 0
         offset += 2
 
+        # Ask for the new model definitions, the reply is handled on the command thread. Until the
+        # server has answered once, e.g. when the client started from the cache, the request sent
+        # by run() is repeated, since it travels over UDP and may be lost.
+        if trackedModelsChanged or not self.modelDefReceived.is_set():
+            self.__requestModelDefUpdate()
+
+        # Filter the poses of all rigid bodies in this frame at once
+        if self.poseFilter is not None:
+            self.poseFilter.apply( self.__frameRigidBodies, timestamp )
+
         # Send information to any listener.
         if self.newFrameListener is not None:
             self.newFrameListener( frameNumber, markerSetCount, unlabeledMarkersCount, rigidBodyCount, skeletonCount,
@@ -357,7 +469,7 @@ class NatNetClient:
         return offset
 
     # Unpack a rigid body description packet
-    def __unpackRigidBodyDescription( self, data ):
+    def __unpackRigidBodyDescription( self, data, descriptions ):
         offset = 0
         name = None
 
@@ -385,16 +497,12 @@ class NatNetClient:
         rb_info['parentID'] = parentID
         rb_info['timestamp'] = timestamp
 
-        rb = {}
-        rb['id'] = id
-
-        self.rigidBodyDescription.append( rb_info )
-        self.rigidBodyList.append( rb )
+        descriptions.append( rb_info )
         
         return offset
 
     # Unpack a skeleton description packet
-    def __unpackSkeletonDescription( self, data ):
+    def __unpackSkeletonDescription( self, data, descriptions ):
         offset = 0
 
         name, separator, remainder = bytes(data[offset:]).partition( b'\0' )
@@ -408,16 +516,14 @@ class NatNetClient:
         offset += 4
 
         for i in range( 0, rigidBodyCount ):
-            offset += self.__unpackRigidBodyDescription( data[offset:] )
+            offset += self.__unpackRigidBodyDescription( data[offset:], descriptions )
 
         return offset
 
     # Unpack a data description packet
     def __unpackDataDescriptions( self, data ):
-        # Reset Rigid Body List
-        self.rigidBodyDescription = []
-        self.rigidBodyList = []
-        
+        descriptions = []
+
         offset = 0
         datasetCount = int.from_bytes( data[offset:offset+4], byteorder='little' )
         offset += 4
@@ -428,19 +534,174 @@ class NatNetClient:
             if( type == 0 ):
                 offset += self.__unpackMarkerSetDescription( data[offset:] )
             elif( type == 1 ):
-                offset += self.__unpackRigidBodyDescription( data[offset:] )
+                offset += self.__unpackRigidBodyDescription( data[offset:], descriptions )
             elif( type == 2 ):
-                offset += self.__unpackSkeletonDescription( data[offset:] )
-            
-    def __dataThreadFunction( self, socket ):
+                offset += self.__unpackSkeletonDescription( data[offset:], descriptions )
+
+        self.__modelDefRequestTime = None
+
+        if descriptions != self.rigidBodyDescription:
+            self.__setModelDef( descriptions )
+            self.modelDefVersion += 1
+
+            if self.modelDefCachePath is not None:
+                # Write the cache off the receiving threads
+                Thread( target = self.__saveModelDefCache, args = (descriptions, ), daemon = True ).start()
+
+            if self.modelDefListener is not None:
+                self.modelDefListener( self.modelDefVersion, descriptions )
+
+    # Replace the rigid body descriptions. The list, index and descriptions are
+    # built first and then swapped in so readers never see a partial update.
+    def __setModelDef( self, descriptions ):
+        subscribedIds = self.__resolveSubscription( descriptions )
+        rigidBodyList = []
+        rigidBodyIndex = {}
+        for rb_info in descriptions:
+            if subscribedIds is not None and rb_info['id'] not in subscribedIds:
+                continue
+            rb = {}
+            rb['id'] = rb_info['id']
+            rigidBodyList.append( rb )
+            rigidBodyIndex[rb['id']] = rb
+
+        self.rigidBodyDescription, self.rigidBodyList, self.rigidBodyIndex = descriptions, rigidBodyList, rigidBodyIndex
+        self.__subscribedIds = subscribedIds
+
+    # The rigid body ids subscribed to with these model definitions, None for all
+    def __resolveSubscription( self, descriptions ):
+        if self.__subscription is None:
+            return None
+        ids = set()
+        for item in self.__subscription:
+            if isinstance( item, int ):
+                ids.add( item )
+            else:
+                ids.update( rb_info['id'] for rb_info in descriptions if rb_info['name'] == item )
+        return frozenset( ids )
+
+    # Only decode the rigid bodies, markers and skeletons subscribed to, everything else is
+    # skipped over in the data packets without being unpacked. rigidBodies is a list of rigid
+    # body ids and names, names are looked up again every time the model definitions change.
+    # markers is a list of the marker classes to keep ('labeled', 'unlabeled') and skeletons
+    # whether to unpack skeletons. None subscribes to all rigid bodies and to the unlabeled markers,
+    # the labeled markers are only added to getMarkerList when 'labeled' is asked for.
+    # getRigidBodyList only has the subscribed rigid bodies, getRigidBodyDescription all of them.
+    def setSubscription( self, rigidBodies=None, markers=None, skeletons=True ):
+        if markers is None:
+            markers = DEFAULT_MARKER_CLASSES
+        for markerClass in markers:
+            if markerClass not in MARKER_CLASSES:
+                raise ValueError( "unknown marker class %r, expected one of %s" % ( markerClass, ', '.join( MARKER_CLASSES ) ) )
+
+        self.lock()
+        self.__subscription = None if rigidBodies is None else tuple( rigidBodies )
+        self.__subscribedMarkers = frozenset( markers )
+        self.__subscribedSkeletons = skeletons
+        self.__setModelDef( self.rigidBodyDescription )
+        self.unlock()
+
+    # Request the model definitions again without waiting for the reply.
+    # Repeated requests are suppressed while one is pending, unless it looks lost.
+    def __requestModelDefUpdate( self, retryInterval=0.5 ):
+        now = time()
+        if self.__modelDefRequestTime is not None and now - self.__modelDefRequestTime < retryInterval:
+            return
+        self.__modelDefRequestTime = now
+        self.sendCommand( self.NAT_REQUEST_MODELDEF, "", self.commandSocket, (self.serverIPAddress, self.commandPort) )
+
+    def __saveModelDefCache( self, descriptions ):
+        try:
+            tmpPath = self.modelDefCachePath + ".tmp"
+            with open( tmpPath, 'w' ) as f:
+                json.dump( descriptions, f )
+            os.replace( tmpPath, self.modelDefCachePath )
+        except OSError as e:
+            trace( "Could not write model definition cache:", e )
+
+    # Load the model definitions cached by a previous session so they can be
+    # used before the server replies. Returns False if there is no usable cache.
+    def loadModelDefCache( self ):
+        if self.modelDefCachePath is None:
+            return False
+        try:
+            with open( self.modelDefCachePath ) as f:
+                descriptions = json.load( f )
+        except ( OSError, ValueError ):
+            return False
+
+        for rb_info in descriptions:
+            rb_info['timestamp'] = tuple( rb_info['timestamp'] )
+
+        self.lock()
+        self.__setModelDef( descriptions )
+        self.unlock()
+        return True
+
+    def __dataThreadFunction( self, socket, sourceAddress ):
         while True:
             # Block for input
             data, addr = socket.recvfrom( 32768 ) # 32k byte buffer size
+            if( sourceAddress is not None and addr[0] != sourceAddress ):
+                continue
             if( len( data ) > 0 ):
                 self.lock()
                 self.__processMessage( data )
                 self.unlock()
 
+    def __commandThreadFunction( self, sock ):
+        # Wake up regularly so requests without a reply time out
+        sock.settimeout( 0.05 )
+        while True:
+            try:
+                data, addr = sock.recvfrom( 32768 ) # 32k byte buffer size
+            except socket.timeout:
+                data = b''
+            if( len( data ) > 0 ):
+                received = perf_counter()
+                self.lock()
+                reply = self.__processMessage( data )
+                self.unlock()
+                # Resolve outside the client lock, futures run their callbacks right away
+                if reply is not None:
+                    self.__resolveRequest( reply[0], reply[1], received )
+            self.__expireRequests()
+
+    # Message id of the server's reply to each request
+    __replies = { NAT_PING: NAT_PINGRESPONSE,
+                  NAT_REQUEST: NAT_RESPONSE,
+                  NAT_REQUEST_MODELDEF: NAT_MODELDEF }
+
+    # The server doesn't number its replies, so a reply resolves the oldest request waiting for that message id
+    def __resolveRequest( self, messageID, value, received ):
+        if messageID == self.NAT_UNRECOGNIZED_REQUEST:
+            messageID = self.NAT_RESPONSE
+            error = value
+        else:
+            error = None
+        with self.__requestLock:
+            pending = self.__pendingRequests.get( messageID )
+            if not pending:
+                return
+            future, sent, deadline = pending.popleft()
+        if error is not None:
+            future.set_exception( error )
+        elif messageID == self.NAT_PINGRESPONSE:
+            value['rtt'] = received - sent
+            future.set_result( value )
+        else:
+            future.set_result( value )
+
+    def __expireRequests( self ):
+        now = perf_counter()
+        expired = []
+        with self.__requestLock:
+            for pending in self.__pendingRequests.values():
+                while pending and pending[0][2] <= now:
+                    expired.append( pending.popleft() )
+        for future, sent, deadline in expired:
+            future.set_exception( TimeoutError( "no reply from NatNet server within %.3fs" % ( deadline - sent ) ) )
+
     def __processMessage( self, data ):
         trace( "Begin Packet\n------------\n" )
 
@@ -451,34 +712,52 @@ class NatNetClient:
         trace( "Packet Size:", packetSize )
 
         offset = 4
+        reply = None
         if( messageID == self.NAT_FRAMEOFDATA ):
             self.__unpackMocapData( data[offset:] )
+            self.frameReceived.set()
         elif( messageID == self.NAT_MODELDEF ):
             self.__unpackDataDescriptions( data[offset:] )
+            self.modelDefReceived.set()
+            reply = self.rigidBodyDescription
         elif( messageID == self.NAT_PINGRESPONSE ):
+            appName, separator, remainder = bytes(data[offset:offset+256]).partition( b'\0' )
             offset += 256   # Skip the sending app's Name field
+            appVersion = struct.unpack( 'BBBB', data[offset:offset+4] )
             offset += 4     # Skip the sending app's Version info
-            self.__natNetStreamVersion = struct.unpack( 'BBBB', data[offset:offset+4] )
+            natNetVersion = struct.unpack( 'BBBB', data[offset:offset+4] )
             offset += 4
+            if( not self.__natNetStreamVersionKnown ):
+                self.__natNetStreamVersion = natNetVersion
+                self.__natNetStreamVersionKnown = True
+            reply = { 'appName': appName.decode( 'utf-8' ), 'appVersion': appVersion, 'natNetVersion': natNetVersion }
         elif( messageID == self.NAT_RESPONSE ):
             if( packetSize == 4 ):
                 commandResponse = int.from_bytes( data[offset:offset+4], byteorder='little' )
                 offset += 4
+                reply = commandResponse
             else:
                 message, separator, remainder = bytes(data[offset:]).partition( b'\0' )
                 offset += len( message ) + 1
                 trace( "Command response:", message.decode( 'utf-8' ) )
+                reply = message.decode( 'utf-8' )
         elif( messageID == self.NAT_UNRECOGNIZED_REQUEST ):
             trace( "Received 'Unrecognized request' from server" )
+            reply = ValueError( "NatNet server did not recognize the request" )
         elif( messageID == self.NAT_MESSAGESTRING ):
             message, separator, remainder = bytes(data[offset:]).partition( b'\0' )
             offset += len( message ) + 1
             trace( "Received message from server:", message.decode( 'utf-8' ) )
+            if self.messageListener is not None:
+                self.messageListener( message.decode( 'utf-8' ) )
         else:
             trace( "ERROR: Unrecognized packet type" )
             
         trace( "End Packet\n----------\n" )
 
+        if reply is not None:
+            return ( messageID, reply )
+
     def lock( self ):
         self._lock.acquire()
 
@@ -494,8 +773,29 @@ class NatNetClient:
     def getRigidBodyList( self ):
         return self.rigidBodyList
 
+    # The rigid bodies of getRigidBodyList that were in the last frame of data. The others
+    # weren't in Motive's data packet and still hold the values of an earlier frame.
+    def getFrameRigidBodies( self ):
+        return self.__frameRigidBodies
+
     def getRigidBodyDescription( self ):
         return self.rigidBodyDescription
+
+    # Block until the server has answered the NAT_REQUEST_MODELDEF sent by run(). The
+    # request is resent every retryInterval seconds since it travels over UDP and may be lost.
+    # Returns False if no model definition arrived within timeout seconds.
+    def waitForModelDef( self, timeout, retryInterval=0.5 ):
+        deadline = time() + timeout
+        while not self.modelDefReceived.wait( max( 0, min( retryInterval, deadline - time() ) ) ):
+            if time() >= deadline:
+                return False
+            self.sendCommand( self.NAT_REQUEST_MODELDEF, "", self.commandSocket, (self.serverIPAddress, self.commandPort) )
+        return True
+
+    # Block until the first frame of data has been received.
+    # Returns False if no frame arrived within timeout seconds.
+    def waitForFrame( self, timeout ):
+        return self.frameReceived.wait( timeout )
          
     def sendCommand( self, command, commandStr, socket, address ):
         # Compose the message in our known message format
@@ -515,7 +815,72 @@ class NatNetClient:
         data += b'\0'
 
         socket.sendto( data, address )
-        
+
+    # Send a command to the server and return a concurrent.futures.Future for its reply.
+    # The future resolves to the command response (a number or string) for NAT_REQUEST,
+    # the rigid body descriptions for NAT_REQUEST_MODELDEF and a dict with the server's
+    # appName, appVersion, natNetVersion and the round trip time rtt in seconds for NAT_PING.
+    # It fails with TimeoutError if there is no reply within timeout seconds.
+    def sendRequest( self, command, commandStr="", timeout=1.0 ):
+        if command not in self.__replies:
+            raise ValueError( "no reply to wait for to command %d, use sendCommand" % command )
+        future = Future()
+        future.set_running_or_notify_cancel()
+        sent = perf_counter()
+        request = [future, sent, sent + timeout]
+        with self.__requestLock:
+            pending = self.__pendingRequests.setdefault( self.__replies[command], deque() )
+            pending.append( request )
+        try:
+            self.sendCommand( command, commandStr, self.commandSocket, (self.serverIPAddress, self.commandPort) )
+        except OSError:
+            # Nothing was sent, so a later reply must not resolve this request
+            with self.__requestLock:
+                pending.remove( request )
+            raise
+        return future
+
+    def __pingThreadFunction( self, interval, timeout ):
+        while not self.__pingStop.is_set():
+            started = perf_counter()
+            # Any failure (no reply, a send error, an error reply) counts as a lost ping,
+            # the thread keeps pinging so the stats never silently stop updating
+            try:
+                rtt = self.sendRequest( self.NAT_PING, timeout=timeout ).result()['rtt']
+            except Exception:
+                rtt = None
+            wait = interval - ( perf_counter() - started )
+            # The replies aren't numbered, so a late reply to a lost ping would resolve the next one
+            # with a far too short round trip time. Nothing is pending for another timeout seconds
+            # so such a reply is dropped, only replies later than twice the timeout still get through.
+            if rtt is None:
+                wait = max( wait, timeout )
+            with self.__requestLock:
+                latency = self.__latency
+                if rtt is None:
+                    latency['lost'] += 1
+                else:
+                    latency['count'] += 1
+                    latency['last'] = rtt
+                    latency['min'] = rtt if latency['min'] is None else min( latency['min'], rtt )
+                    latency['max'] = rtt if latency['max'] is None else max( latency['max'], rtt )
+                    latency['mean'] = rtt if latency['mean'] is None else latency['mean'] + ( rtt - latency['mean'] ) / latency['count']
+            self.__pingStop.wait( max( 0, wait ) )
+
+    # Ping the server every interval seconds to measure the round trip time of the command channel.
+    def startPing( self, interval=1.0, timeout=1.0 ):
+        self.__pingStop.clear()
+        Thread( target = self.__pingThreadFunction, args = (interval, timeout), daemon = True ).start()
+
+    def stopPing( self ):
+        self.__pingStop.set()
+
+    # Round trip times of the pings in seconds: last, min, max and mean, plus the number of
+    # pings answered (count) and lost to a timeout or an error (lost).
+    def getLatencyStats( self ):
+        with self.__requestLock:
+            return dict( self.__latency )
+
     def run( self ):
         # Create the data socket
         self.dataSocket = self.__createDataSocket( self.dataPort )
@@ -530,12 +895,17 @@ class NatNetClient:
             exit
 
         # Create a separate thread for receiving data packets
-        dataThread = Thread( target = self.__dataThreadFunction, args = (self.dataSocket, ))
+        sourceAddress = None
+        if( self.dataSourceAddress is not None ):
+            sourceAddress = socket.gethostbyname( self.dataSourceAddress )
+        dataThread = Thread( target = self.__dataThreadFunction, args = (self.dataSocket, sourceAddress), daemon = True)
         dataThread.start()
 
         # Create a separate thread for receiving command packets
-        commandThread = Thread( target = self.__dataThreadFunction, args = (self.commandSocket, ))
+        commandThread = Thread( target = self.__commandThreadFunction, args = (self.commandSocket, ), daemon = True)
         commandThread.start()
 
-        self.sendCommand( self.NAT_REQUEST_MODELDEF, "", self.commandSocket, (self.serverIPAddress, self.commandPort) )
+        # The reply to this ping sets the NatNet version used to unpack the data packets
+        self.sendRequest( self.NAT_PING )
+        self.__requestModelDefUpdate()
     
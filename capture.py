@@ -13,7 +13,14 @@ import msgpack as serializer
 import zmq
 from zmq.utils.monitor import recv_monitor_message
 import json
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from queue import Queue
+from threading import Thread
+from quality import Quality_Monitor
+from recording import Recording_Writer
 
 assert zmq.__version__ > '15.1'
 
@@ -23,15 +30,22 @@ class Msg_Receiver(object):
     Not threadsafe. Make a new one for each thread
     __init__ will block until connection is established.
     '''
-    def __init__(self, ctx, url, topics=(), block_until_connected=True):
+    def __init__(self, ctx, url, topics=(), block_until_connected=True, timeout=None):
         self.socket = zmq.Socket(ctx, zmq.SUB)
         assert type(topics) != str
 
         if block_until_connected:
             # connect node and block until a connecetion has been made
+            # or until timeout seconds have passed
             monitor = self.socket.get_monitor_socket()
             self.socket.connect(url)
+            deadline = None if timeout is None else time() + timeout
             while True:
+                if deadline is not None:
+                    remaining = deadline - time()
+                    if remaining <= 0 or not monitor.poll(remaining * 1000):
+                        self.socket.disable_monitor()
+                        raise TimeoutError("ZMQ connection to %s timed out after %.1fs" % (url, timeout))
                 status = recv_monitor_message(monitor)
                 if status['event'] == zmq.EVENT_CONNECTED:
                     break
@@ -75,7 +89,127 @@ class Msg_Receiver(object):
     def __del__(self):
         self.socket.close()
 
-if __name__ == '__main__':
+def request_sub_port(ctx, url, timeout):
+    '''Ask Pupil Remote at url for the session unique IPC SUB port.
+    Raises TimeoutError if Pupil Remote does not answer within timeout seconds.
+    '''
+    requester = ctx.socket(zmq.REQ)
+    requester.setsockopt(zmq.LINGER, 0)
+    requester.connect(url)
+    try:
+        requester.send_string('SUB_PORT')
+        if not requester.poll(timeout * 1000):
+            raise TimeoutError("Pupil Remote at %s did not answer SUB_PORT within %.1fs" % (url, timeout))
+        return requester.recv().decode("utf-8")
+    finally:
+        requester.close()
+
+def connect_pupil_labs(ctx, args, timeout, ready):
+    '''Connect to Pupil Remote and subscribe to the enabled pupil topics.
+    Blocks until the first message of every subscribed topic is waiting,
+    recording the time each source became ready in the ready dict.
+    Returns a dict of topic name -> Msg_Receiver.
+    '''
+    start = time()
+    deadline = start + timeout
+
+    remote_url = 'tcp://%s:%d' % (args.pupil_labs_ip, args.pupil_labs_port)
+    ipc_sub_port = request_sub_port(ctx, remote_url, timeout)
+    ready['pupil remote'] = time() - start
+
+    sub_url = 'tcp://%s:%s' % (args.pupil_labs_ip, ipc_sub_port)
+    print( 'ipc_sub_port:', ipc_sub_port )
+    print( sub_url )
+
+    # Subscribe to pupils
+    topics = {}
+    if not args.pupil0_off:
+        topics['pupil0'] = 'pupil.0'
+    if not args.pupil1_off:
+        topics['pupil1'] = 'pupil.1'
+
+    receivers = {}
+    for name, topic in topics.items():
+        receivers[name] = Msg_Receiver(
+            ctx, sub_url, topics=(topic,), timeout=max(0, deadline - time()))
+
+    # Wait until every receiver has data without consuming it
+    poller = zmq.Poller()
+    waiting = {}
+    for name, receiver in receivers.items():
+        poller.register(receiver.socket, zmq.POLLIN)
+        waiting[receiver.socket] = name
+    while waiting:
+        remaining = deadline - time()
+        if remaining <= 0:
+            raise TimeoutError("no data on %s within %.1fs" % (', '.join(sorted(waiting.values())), timeout))
+        for sock, event in poller.poll(remaining * 1000):
+            if sock in waiting:
+                ready[waiting.pop(sock)] = time() - start
+                poller.unregister(sock)
+
+    # Notifications are only sent occasionally, so don't wait for data
+    if args.trigger_topic:
+        receivers['trigger'] = Msg_Receiver(
+            ctx, sub_url, topics=(args.trigger_topic,), timeout=max(0, deadline - time()))
+
+    return receivers
+
+def connect_optitrack(args, timeout, ready):
+    '''Start a NatNetClient and block until both the model definitions and
+    the first frame of data have arrived, recording the time each became
+    ready in the ready dict. Model definitions cached by an earlier session
+    are used straight away, the server's reply then updates them.
+    Returns the running client.
+    '''
+    start = time()
+    deadline = start + timeout
+
+    # This will create a new NatNet client
+    client = NatNetClient(args.optitrack_ip,
+                          args.optitrack_multicast_address,
+                          args.optitrack_command_port,
+                          args.optitrack_data_port)
+
+    # Only unpack what is recorded
+    if args.rigid_bodies is not None or args.markers is not None or args.no_skeletons:
+        client.setSubscription(args.rigid_bodies, args.markers, not args.no_skeletons)
+
+    # --check measures how long the server takes to answer, so it doesn't use the cache
+    if args.optitrack_model_cache and not args.check:
+        client.modelDefCachePath = args.optitrack_model_cache
+    cached = client.loadModelDefCache()
+
+    if args.pose_filter:
+        from filters import Pose_Filter
+        client.poseFilter = Pose_Filter(args.pose_filter,
+                                        min_cutoff=args.pose_filter_min_cutoff,
+                                        beta=args.pose_filter_beta,
+                                        process_noise=args.pose_filter_process_noise,
+                                        measurement_noise=args.pose_filter_measurement_noise,
+                                        max_gap=args.pose_filter_max_gap)
+
+    # Start up the streaming client.
+    # This will run perpetually, and operate on a separate thread.
+    client.run()
+
+    if cached:
+        ready['optitrack modeldef (cached)'] = time() - start
+    elif not client.waitForModelDef(max(0, deadline - time())):
+        raise TimeoutError("no model definition from NatNet server %s within %.1fs" % (args.optitrack_ip, timeout))
+    else:
+        ready['optitrack modeldef'] = time() - start
+
+    if not client.waitForFrame(max(0, deadline - time())):
+        raise TimeoutError("no frame of data from NatNet server %s within %.1fs" % (args.optitrack_ip, timeout))
+    ready['optitrack frame'] = time() - start
+
+    if args.optitrack_ping_interval > 0:
+        client.startPing(args.optitrack_ping_interval)
+
+    return client
+
+def build_parser():
     parser = argparse.ArgumentParser(
         prog='python capture.py',
          description='''
@@ -100,9 +234,28 @@ if __name__ == '__main__':
                         default=1511,
                         type=int,
                         help="data port for OptiTrack. (default: 1511)")
+    parser.add_argument("--optitrack-model-cache",
+                        default="optitrack_modeldef.json",
+                        help="file caching the last OptiTrack model definitions, empty to disable. (default: optitrack_modeldef.json)")
+    parser.add_argument("--optitrack-ping-interval",
+                        default=1.0,
+                        type=float,
+                        help="seconds between pings measuring the round trip time to OptiTrack, 0 to disable. (default: 1.0)")
     parser.add_argument("--optitrack-multicast-address",
                         default="239.255.42.99",
                         help="multicast address for OptiTrack. (default: 239.255.42.99)")
+    parser.add_argument("--rigid-bodies",
+                        nargs='+',
+                        type=lambda item: int(item) if item.isdigit() else item,
+                        metavar='ID_OR_NAME',
+                        help="only record these OptiTrack rigid bodies, by id or name. (default: all)")
+    parser.add_argument("--markers",
+                        nargs='*',
+                        choices=('labeled', 'unlabeled'),
+                        help="only record these OptiTrack marker classes, none if no class is given. (default: unlabeled)")
+    parser.add_argument('--no-skeletons',
+                        action='store_true',
+                        help="skip the rigid bodies of OptiTrack skeletons.")
     parser.add_argument("--pupil-labs-ip",
                         default="127.0.0.1",
                         help="ip address for Pupil Labs. (default: 127.0.0.1)")
@@ -126,9 +279,415 @@ if __name__ == '__main__':
                         default=70,
                         type=int,
                         help="sets the max number of frames captured per second. (default: 70)")
-    args = parser.parse_args()
+    parser.add_argument("--pose-filter",
+                        choices=('one-euro', 'kalman'),
+                        help="add filteredPosition and filteredRotation to every rigid body.")
+    parser.add_argument("--pose-filter-min-cutoff",
+                        default=1.0,
+                        type=float,
+                        help="One-Euro minimum cutoff frequency in Hz. (default: 1.0)")
+    parser.add_argument("--pose-filter-beta",
+                        default=20.0,
+                        type=float,
+                        help="One-Euro speed coefficient. (default: 20.0)")
+    parser.add_argument("--pose-filter-process-noise",
+                        default=50.0,
+                        type=float,
+                        help="Kalman acceleration variance in m^2/s^4. (default: 50.0)")
+    parser.add_argument("--pose-filter-measurement-noise",
+                        default=1e-6,
+                        type=float,
+                        help="Kalman position measurement variance in m^2. (default: 1e-6)")
+    parser.add_argument("--pose-filter-max-gap",
+                        default=0.5,
+                        type=float,
+                        help="seconds a body may be invalid before its filter restarts. (default: 0.5)")
+    parser.add_argument("--gaze-calibration",
+                        help="path to a gaze calibration file, adds gaze-in-world rays to every frame.")
+    parser.add_argument("--gaze-batch-size",
+                        default=8,
+                        type=int,
+                        help="number of frames gaze is computed for at once. (default: 8)")
+    parser.add_argument("--gaze-pub-port",
+                        type=int,
+                        help="also publish gaze rays on this port as gaze.world.0 / gaze.world.1 topics.")
+    parser.add_argument("--pre-trigger",
+                        default=0.0,
+                        type=float,
+                        help="seconds of full-rate frames kept in memory and saved when an event is triggered. (default: 0)")
+    parser.add_argument("--post-trigger",
+                        default=0.0,
+                        type=float,
+                        help="seconds of full-rate frames saved after an event is triggered. (default: 0)")
+    parser.add_argument("--full-rate",
+                        default=240,
+                        type=int,
+                        help="frames captured per second while pre/post trigger recording is on. (default: 240)")
+    parser.add_argument("--events-output",
+                        help="path to the full-rate event output file. (default: <output>.events.json)")
+    parser.add_argument("--trigger-port",
+                        type=int,
+                        help="trigger events by sending their name to this port with a ZMQ REQ socket.")
+    parser.add_argument("--trigger-topic",
+                        help="trigger events on this Pupil notification topic, e.g. notify.recording.started.")
+    parser.add_argument("--float-format",
+                        help="write floats with this fixed format, e.g. %%.6f, instead of their shortest repr. Faster, see encoder.py.")
+    parser.add_argument('--codec',
+                        action='store_true',
+                        help="store rigid bodies and markers with the delta and quantization codec, see codec.py.")
+    parser.add_argument("--codec-position-resolution",
+                        default=1e-5,
+                        type=float,
+                        help="codec resolution of positions in m. (default: 1e-5)")
+    parser.add_argument("--codec-rotation-resolution",
+                        default=1e-6,
+                        type=float,
+                        help="codec resolution of quaternion components. (default: 1e-6)")
+    parser.add_argument("--codec-keyframe-interval",
+                        default=100,
+                        type=int,
+                        help="number of frames from one codec keyframe to the next. (default: 100)")
+    parser.add_argument("--quality-window",
+                        default=10.0,
+                        type=float,
+                        help="seconds of data the live quality metrics cover. (default: 10)")
+    parser.add_argument("--low-confidence",
+                        default=0.6,
+                        type=float,
+                        help="pupil confidence below which samples count as low confidence. (default: 0.6)")
+    parser.add_argument("--alarm-marker-error",
+                        default=0.002,
+                        type=float,
+                        help="alarm when a rigid body's mean marker error exceeds this many m, 0 to disable. (default: 0.002)")
+    parser.add_argument("--alarm-valid-percent",
+                        default=90.0,
+                        type=float,
+                        help="alarm when a rigid body is tracked in fewer percent of frames, 0 to disable. (default: 90)")
+    parser.add_argument("--alarm-confidence",
+                        default=0.6,
+                        type=float,
+                        help="alarm when an eye's mean confidence drops below this, 0 to disable. (default: 0.6)")
+    parser.add_argument("--alarm-low-confidence-runs",
+                        default=10.0,
+                        type=float,
+                        help="alarm when an eye has more low-confidence runs per minute, 0 to disable. (default: 10)")
+    parser.add_argument("--startup-timeout",
+                        default=5.0,
+                        type=float,
+                        help="seconds to wait for every source to become ready. (default: 5.0)")
+    parser.add_argument('--check',
+                        action='store_true',
+                        help="report how long each source takes to become ready and exit.")
+    return parser
+
+def check_args(parser, args):
+    '''Reject combinations of arguments that can't work together.'''
+    if args.trigger_topic and args.pupil_labs_off:
+        parser.error("--trigger-topic needs Pupil Labs")
+
+    if (args.trigger_port or args.trigger_topic) and not (args.pre_trigger > 0 or args.post_trigger > 0):
+        parser.error("--trigger-port and --trigger-topic need --pre-trigger or --post-trigger")
+
+    if args.gaze_calibration and (args.optitrack_off or args.pupil_labs_off):
+        parser.error("--gaze-calibration needs both OptiTrack and Pupil Labs data")
+
+    if args.float_format:
+        try:
+            args.float_format % 1.0
+        except (TypeError, ValueError):
+            parser.error("--float-format must format one float, e.g. %.6f")
+
+class Capture_Loop(object):
+    '''
+    The capture loop: records a frame from the Pupil Labs receivers and the
+    NatNet client every frame interval, with everything args turns on (gaze
+    rays, event recording, codec, float format, quality metrics). soak.py
+    runs this same loop against synthetic sources.
+    '''
+    def __init__(self, args, receivers=None, client=None):
+        self.args = args
+        self.receivers = receivers or {}
+        self.client = client
+
+        # Frames are written with json.dumps, or with writers compiled for a fixed float format
+        self.encode_frame = json.dumps
+        output_header = {}
+        if args.float_format:
+            from encoder import Frame_Encoder
+            self.encode_frame = Frame_Encoder(args.float_format).encode
+            output_header['floatFormat'] = args.float_format
+
+        self.modelDefVersion = None
+        if client is not None:
+            print( client.get_version() )
+
+            client.lock()
+            output_header['rigidBodyInfo'] = client.getRigidBodyDescription()
+            if args.rigid_bodies is not None or args.markers is not None or args.no_skeletons:
+                output_header['subscription'] = {
+                    'rigidBodies': args.rigid_bodies,
+                    'markers': args.markers,
+                    'skeletons': not args.no_skeletons }
+                names = set(rb_info['name'] for rb_info in output_header['rigidBodyInfo'])
+                ids = set(rb_info['id'] for rb_info in output_header['rigidBodyInfo'])
+                missing = [str(item) for item in args.rigid_bodies or () if item not in names and item not in ids]
+                if missing:
+                    print( 'Rigid bodies not found in OptiTrack (yet):', ', '.join(missing) )
+            output_header['modelDefVersion'] = self.modelDefVersion = client.modelDefVersion
+            if client.poseFilter is not None:
+                pose_filter = client.poseFilter
+                output_header['poseFilter'] = {
+                    'method': pose_filter.method,
+                    'minCutoff': pose_filter.min_cutoff,
+                    'beta': pose_filter.beta,
+                    'processNoise': pose_filter.process_noise,
+                    'measurementNoise': pose_filter.measurement_noise,
+                    'maxGap': pose_filter.max_gap }
+            client.unlock()
+
+        # Gaze rays are computed for batches of frames before they are written
+        self.gaze_mapper = None
+        self.gaze_publisher = None
+        self.frame_batch_size = 1
+        if args.gaze_calibration:
+            from gaze import Gaze_Mapper
+            with open(args.gaze_calibration) as f:
+                output_header['gazeCalibration'] = json.load(f)
+            self.gaze_mapper = Gaze_Mapper(output_header['gazeCalibration'])
+            self.frame_batch_size = max(1, args.gaze_batch_size)
+
+            if args.gaze_pub_port:
+                self.gaze_publisher = zmq.Context.instance().socket(zmq.PUB)
+                self.gaze_publisher.bind('tcp://*:%d' % args.gaze_pub_port)
 
-    output_header = {}
+        # Full-rate frames around events go to a separate recording
+        self.event_recorder = None
+        self.trigger_socket = None
+        self.trigger_receiver = None
+        if args.pre_trigger > 0 or args.post_trigger > 0:
+            from triggers import Event_Recorder
+            self.events_output = args.events_output or os.path.splitext(args.output)[0] + '.events.json'
+            self.events_file = open(self.events_output, 'w')
+            self.event_recorder = Event_Recorder(Recording_Writer(self.events_file, output_header),
+                                                 args.pre_trigger, args.post_trigger, args.full_rate)
+
+            # Events can be sent as a string over a ZMQ REQ socket
+            if args.trigger_port:
+                self.trigger_socket = zmq.Context.instance().socket(zmq.REP)
+                self.trigger_socket.bind('tcp://*:%d' % args.trigger_port)
+
+            # or be a Pupil notification
+            if args.trigger_topic:
+                self.trigger_receiver = self.receivers['trigger']
+
+        # Only the main recording is coded, the event recording keeps plain frames
+        self.encoder = None
+        self.recording_header = output_header
+        if args.codec:
+            from codec import Mocap_Encoder, codec_params
+            params = codec_params(args.codec_position_resolution,
+                                  args.codec_rotation_resolution,
+                                  args.codec_keyframe_interval)
+            self.encoder = Mocap_Encoder(params)
+            self.recording_header = dict(output_header, codec=params)
+
+        # Quality metrics are shown live and summarised in the header when recording stops
+        self.quality = Quality_Monitor(args.quality_window, args.low_confidence,
+                                       args.alarm_marker_error, args.alarm_valid_percent,
+                                       args.alarm_confidence, args.alarm_low_confidence_runs)
+        self.quality_size = self.quality.summary_size(len(output_header.get('rigidBodyInfo', ())))
+
+        self.continuous_interval = 1.0/args.max_frames_per_second
+        self.next_write = None
+
+    def write_frames(self, frames, writer):
+        gaze_publisher = self.gaze_publisher
+        event_recorder = self.event_recorder
+        encoder = self.encoder
+        encode_frame = self.encode_frame
+        if self.gaze_mapper is not None:
+            for obj, fields in zip(frames, self.gaze_mapper.map_frames(frames)):
+                obj.update(fields)
+                if gaze_publisher is not None:
+                    for key, ray in fields.items():
+                        payload = dict(ray, time=obj['time'])
+                        gaze_publisher.send_string('gaze.world.' + key[-1], zmq.SNDMORE)
+                        gaze_publisher.send(serializer.dumps(payload, use_bin_type=True))
+        for obj in frames:
+            text = None
+            if event_recorder is not None:
+                text = encode_frame(obj)
+                event_recorder.add(obj['time'], text)
+                # Decimate the continuous recording to its own rate, but never drop static updates
+                if self.next_write is not None and obj['time'] < self.next_write:
+                    if 'static' not in obj:
+                        continue
+                else:
+                    # Keep to the schedule, without catching up after a stall
+                    if self.next_write is None or self.next_write + self.continuous_interval <= obj['time']:
+                        self.next_write = obj['time']
+                    self.next_write += self.continuous_interval
+            if encoder is not None:
+                # The encoder codes each frame against the previous one written
+                text = encode_frame(encoder.encode(obj))
+            elif text is None:
+                text = encode_frame(obj)
+            writer.write(text)
+
+    @contextmanager
+    def closing_events(self):
+        '''Close the events recording however recording stops, so it stays readable.'''
+        try:
+            yield
+        finally:
+            if self.event_recorder is not None:
+                try:
+                    self.event_recorder.writer.close()
+                finally:
+                    self.events_file.close()
+
+    def run(self, duration=None, on_frame=None, status=None, keyboard=True):
+        '''
+        Record until Ctrl-C, or for duration seconds. on_frame is called
+        with the number of every recorded frame, status returns extra text
+        for the status line. keyboard triggers events with Enter. Returns
+        the number of frames recorded.
+        '''
+        args = self.args
+        client = self.client
+        pupil0 = self.receivers.get('pupil0')
+        pupil1 = self.receivers.get('pupil1')
+        event_recorder = self.event_recorder
+        quality = self.quality
+
+        keypresses = None
+        if event_recorder is not None:
+            print( 'Events are saved to', self.events_output )
+            if keyboard:
+                print( 'Press Enter to trigger an event' )
+                keypresses = Queue()
+                Thread(target=lambda: [keypresses.put(line) for line in sys.stdin], daemon=True).start()
+        start_time = time()
+        frame_interval = 1.0/args.full_rate if event_recorder is not None else self.continuous_interval
+        ping = client is not None and args.optitrack_ping_interval > 0
+        ping_count = 0
+
+        with open(args.output, 'w') as f, self.closing_events():
+            writer = Recording_Writer(f, self.recording_header, reserve=('quality', self.quality_size))
+            pending = []
+            frame = 1
+            try:
+                st = time()
+                next_frame = st
+                while duration is None or time() - start_time < duration:
+                    if frame % 100 == 0:
+                        et = time()
+                        sys.stdout.write("\rframe: %d at %f fps" % (frame, 100.0/(et-st)))
+                        if ping:
+                            latency = client.getLatencyStats()
+                            if latency['last'] is not None:
+                                sys.stdout.write(" rtt: %.1f ms" % (latency['last'] * 1000.0))
+                            if latency['lost']:
+                                sys.stdout.write(" lost pings: %d" % latency['lost'])
+                        if event_recorder is not None:
+                            sys.stdout.write(" events: %d%s" % (event_recorder.event_count,
+                                                               " (recording)" if event_recorder.active else ""))
+                        sys.stdout.write(" " + quality.status(quality.check_alarms(et - start_time)))
+                        if status is not None:
+                            sys.stdout.write(" " + status())
+                        sys.stdout.flush()
+                        st = et
+
+                    if event_recorder is not None:
+                        now = time() - start_time
+                        while keypresses is not None and not keypresses.empty():
+                            keypresses.get()
+                            event_recorder.trigger(now, 'keypress', 'keypress')
+                        if self.trigger_socket is not None and self.trigger_socket.poll(0):
+                            event_recorder.trigger(now, self.trigger_socket.recv_string(), 'zmq')
+                            self.trigger_socket.send_string('ok')
+                        if self.trigger_receiver is not None and self.trigger_receiver.socket.poll(0):
+                            topic, notification = self.trigger_receiver.recv()
+                            event_recorder.trigger(now, notification.get('subject', topic), topic)
+
+                    obj = {}
+                    obj['frame'] = frame
+                    obj['time'] = time() - start_time
+                    present = None
+
+                    if client is not None:
+                        client.lock()
+
+                    if pupil0 is not None:
+                        pupil0_topic, pupil0_msg = pupil0.recv()
+                        obj['pupil0'] = pupil0_msg
+
+                    if pupil1 is not None:
+                        pupil1_topic, pupil1_msg = pupil1.recv()
+                        obj['pupil1'] = pupil1_msg
+
+                    if client is not None:
+                        # Record changed model definitions as a versioned static update
+                        if client.modelDefVersion != self.modelDefVersion:
+                            self.modelDefVersion = client.modelDefVersion
+                            obj['static'] = {
+                                'modelDefVersion': self.modelDefVersion,
+                                'rigidBodyInfo': client.getRigidBodyDescription() }
+
+                        # The client updates the rigid body dicts in place, copy them
+                        obj['rigidBodies'] = [dict(rb) for rb in client.getRigidBodyList()]
+                        obj['markers'] = client.getMarkerList()
+                        present = set(rb['id'] for rb in client.getFrameRigidBodies())
+
+                        client.unlock()
+
+                        # Record each new round trip time to the server once
+                        if ping:
+                            latency = client.getLatencyStats()
+                            if latency['count'] != ping_count:
+                                ping_count = latency['count']
+                                obj['pingRTT'] = latency['last']
+
+                    quality.add_frame(obj['time'], obj, present)
+
+                    pending.append(obj)
+                    if len(pending) >= self.frame_batch_size:
+                        # Taken off pending first, so a Ctrl-C while writing can't make shutdown write it again
+                        batch, pending = pending, []
+                        self.write_frames(batch, writer)
+
+                    if on_frame is not None:
+                        on_frame(frame)
+                    frame = frame + 1
+
+                    # Keep to the frame schedule, so waking up late doesn't lower the rate.
+                    # A few late frames are caught up, after a longer stall it starts again from now.
+                    next_frame += frame_interval
+                    delay = next_frame - time()
+                    if delay > 0:
+                        sleep(delay)
+                    elif delay < -10 * frame_interval:
+                        next_frame = time()
+            except KeyboardInterrupt:
+                pass
+
+            self.write_frames(pending, writer)
+            writer.close(quality.summary())
+
+        if self.encoder is not None:
+            print( "" )
+            print( 'codec: %d frames, %d keyframes, largest quantization error %g' %
+                   (self.encoder.frames, self.encoder.keyframes, self.encoder.max_error) )
+        if quality.alarms:
+            print( "" )
+        for alarm in quality.alarms.values():
+            print( 'quality alarm: %s %s from %.1fs to %.1fs' % (alarm['alarm'], alarm['source'], alarm['first'], alarm['last']) )
+        return frame - 1
+
+if __name__ == '__main__':
+    parser = build_parser()
+    args = parser.parse_args()
+    check_args(parser, args)
 
     print( 'Starting program' )
     print( 'Pupil Labs:', not args.pupil_labs_off )
@@ -137,33 +696,6 @@ if __name__ == '__main__':
         print( 'Pupil.0:', not args.pupil0_off )
         print( 'Pupil.1:', not args.pupil1_off )
         print( 'tcp://%s:%d' % (args.pupil_labs_ip, args.pupil_labs_port) )
-    
-        # tap into the IPC backbone of pupil capture
-        ctx = zmq.Context()
-
-        # the requester talks to Pupil remote and
-        # recevied the session unique IPC SUB URL
-        requester = ctx.socket(zmq.REQ)
-        requester.connect( 'tcp://%s:%d' % (args.pupil_labs_ip, args.pupil_labs_port) )
-
-        requester.send_string('SUB_PORT')
-        ipc_sub_port = requester.recv().decode("utf-8")
-
-        print( 'ipc_sub_port:', ipc_sub_port )
-
-        print( 'tcp://%s:%s' % (args.pupil_labs_ip, ipc_sub_port) )
-
-        # Subscribe to pupils
-        if not args.pupil0_off:
-            pupil0 = Msg_Receiver(
-                ctx, 'tcp://%s:%s' % (args.pupil_labs_ip, ipc_sub_port),
-                topics=('pupil.0',))
-            
-        if not args.pupil1_off:
-            pupil1 = Msg_Receiver(
-                ctx, 'tcp://%s:%s' % (args.pupil_labs_ip, ipc_sub_port),
-                topics=('pupil.1',))
-        sleep(1)
 
     print( 'OptiTrack:', not args.optitrack_off )
 
@@ -172,80 +704,42 @@ if __name__ == '__main__':
         print( 'command port:', args.optitrack_command_port )
         print( 'data port:', args.optitrack_data_port )
         print( 'multicast address:', args.optitrack_multicast_address )
-        
-        # This will create a new NatNet client
-        streamingClient = NatNetClient(args.optitrack_ip,
-                                       args.optitrack_multicast_address,
-                                       args.optitrack_command_port,
-                                       args.optitrack_data_port)
 
-        # Start up the streaming client now that the callbacks are set up.
-        # This will run perpetually, and operate on a separate thread.
-        streamingClient.run()
+    # Connect to all sources concurrently. Each connection finishes as soon as
+    # its source is ready or fails once the startup timeout has passed.
+    ready = {}
+    startup = {}
+    with ThreadPoolExecutor() as executor:
+        if not args.pupil_labs_off:
+            # tap into the IPC backbone of pupil capture
+            ctx = zmq.Context()
+            startup['Pupil Labs'] = executor.submit(
+                connect_pupil_labs, ctx, args, args.startup_timeout, ready)
+        if not args.optitrack_off:
+            startup['OptiTrack'] = executor.submit(
+                connect_optitrack, args, args.startup_timeout, ready)
 
-        print( streamingClient.get_version() )
-        
-        sleep(2)
+    failed = False
+    for name, future in startup.items():
+        error = future.exception()
+        if error is not None:
+            print( '%s failed to start: %s' % (name, error) )
+            failed = True
 
-        output_header['rigidBodyInfo'] = streamingClient.getRigidBodyDescription()
+    if args.check:
+        for name, elapsed in sorted(ready.items(), key=lambda item: item[1]):
+            print( '%-20s ready after %.3fs' % (name, elapsed) )
+        sys.exit(1 if failed else 0)
+
+    if failed:
+        sys.exit(1)
+
+    receivers = startup['Pupil Labs'].result() if not args.pupil_labs_off else None
+    streamingClient = startup['OptiTrack'].result() if not args.optitrack_off else None
+    capture = Capture_Loop(args, receivers, streamingClient)
 
-    
     input( 'Press Enter to continue and start recording...' )
     print( "Recording Started" )
     print( 'Press Ctrl-C to stop recording' )
-    start_time = time()
-    
-    with open(args.output, 'w') as f:
-        f.write('{\"static\": \n')
-        f.write(json.dumps(output_header))
-        f.write(',\n\"frames\": [\n')
-        try:
-            first_frame = True
-            frame = 1
-            st = time()
-            while True:
-                sft = time()
-                if frame % 100 == 0:
-                    et = time()
-                    sys.stdout.write("\rframe: %d at %f fps" % (frame, 100.0/(et-st)))
-                    sys.stdout.flush()
-                    st = et
-                
-                obj = {}
-                obj['frame'] = frame
-                obj['time'] = time() - start_time
-                
-                if not args.optitrack_off:
-                    streamingClient.lock()
-                    
-                if not args.pupil_labs_off:
-                    if not args.pupil0_off:
-                        pupil0_topic, pupil0_msg = pupil0.recv()
-                        obj['pupil0'] = pupil0_msg
-                    
-                    if not args.pupil1_off:
-                        pupil1_topic, pupil1_msg = pupil1.recv()
-                        obj['pupil1'] = pupil1_msg
-                    
-                if not args.optitrack_off:
-                    obj['rigidBodies'] = streamingClient.getRigidBodyList()
-                    obj['markers'] = streamingClient.getMarkerList()
-                
-                if not args.optitrack_off:        
-                    streamingClient.unlock()
-
-                if not first_frame:
-                    f.write(",\n")
-                else:
-                    first_frame = False
-                
-                f.write(json.dumps(obj))
-                frame = frame + 1
-
-                sleep(max(0, (1.0/args.max_frames_per_second) - (time() - sft)))
-                
-        except KeyboardInterrupt:
-            f.write(']}\n')
-            f.close()
-            print( "Done" )
-
+    capture.run()
+    print( "Done" )
@@ -0,0 +1,348 @@
+'''
+Delta and quantization codec for the mocap data of recordings.
+
+Rigid body poses and marker positions change very little from one frame to
+the next, but every frame stores them in full as float text. With the codec
+the rigidBodies and markers of a frame are replaced by a "mocap" entry:
+
+keyframe  {"keyframe": layout, "values": [...], "valid": bits, "markers": markers}
+delta     {"delta": [...], "valid": bits, "markers": markers}
+
+All positions and marker errors (in m) and rotations (quaternion
+components) of the rigid bodies are quantized to integer multiples of
+positionResolution and rotationResolution. A keyframe stores these
+integers and the layout of the rigid bodies, which is the rigid bodies
+with every coded value removed (ids, marker counts, marker ids and sizes,
+...). The following frames only store the change of every integer since
+the previous frame. The deltas are taken between the quantized values, so
+decoding reconstructs every frame exactly to within half a resolution
+step, however long the run of deltas is. The valid flags of the rigid
+bodies are a bit mask, bit i for the i-th body.
+
+The unlabeled and labeled markers of the frame come and go nearly every
+frame, so they are coded on their own and don't force a keyframe:
+
+markers   {"layout": [...], "values": [...]} or {"delta": [...]}
+
+Their positions are quantized the same way. When the markers are the same
+as in the previous frame (same count, labels and ids) only the deltas are
+stored, otherwise their layout and values in full, which is no smaller
+than a keyframe of the markers alone.
+
+A keyframe is written every keyframeInterval frames, whenever the layout
+of the rigid bodies changes and with every static update. The markers are
+always stored in full with a keyframe. The codec parameters are stored in
+the header of the recording under "codec".
+
+Encoding and decoding quantize all values of a frame at once using NumPy.
+Decoding has to start at a keyframe.
+'''
+
+import argparse
+import json
+import os
+import numpy as np
+
+from recording import open_recording, iter_frames, Recording_Writer
+
+CODEC_NAME = 'delta-quantize'
+
+# Coded values of every rigid body: their length (None for a single number) and the resolution used for them
+BODY_FIELDS = {
+    'position': (3, 'positionResolution'),
+    'rotation': (4, 'rotationResolution'),
+    'filteredPosition': (3, 'positionResolution'),
+    'filteredRotation': (4, 'rotationResolution'),
+    'markerError': (None, 'positionResolution') }
+
+MOCAP_KEYS = ('rigidBodies', 'markers')
+
+def codec_params(position_resolution=1e-5, rotation_resolution=1e-6, keyframe_interval=100):
+    '''The codec entry for the header of a recording.'''
+    return {'name': CODEC_NAME,
+            'positionResolution': position_resolution,
+            'rotationResolution': rotation_resolution,
+            'keyframeInterval': keyframe_interval}
+
+def split_frame(frame):
+    '''
+    Split the mocap data of a frame into its layout, the flat list of its
+    coded values and the valid bit mask of its rigid bodies.
+    '''
+    values = []
+    valid = 0
+    bodies = []
+    for i, rb in enumerate(frame.get('rigidBodies', ())):
+        body = {}
+        coded = []
+        marker_values = []
+        for key, item in rb.items():
+            if key == 'markers':
+                markers = []
+                for marker in item:
+                    markers.append(dict((k, v) for k, v in marker.items() if k != 'position'))
+                    marker_values.extend(marker['position'])
+                body['markers'] = markers
+            elif key == 'valid':
+                coded.append(key)
+                if item:
+                    valid |= 1 << i
+            elif key in BODY_FIELDS:
+                coded.append(key)
+                if BODY_FIELDS[key][0] is None:
+                    values.append(item)
+                else:
+                    values.extend(item)
+            else:
+                body[key] = item
+        # join_frame reads the coded fields of a body first, then its markers,
+        # whatever the order of the keys (the pose filter adds its fields last)
+        values.extend(marker_values)
+        body['coded'] = coded
+        bodies.append(body)
+
+    markers = []
+    for marker in frame.get('markers', ()):
+        markers.append(dict((k, v) for k, v in marker.items() if k != 'position'))
+        values.extend(marker['position'])
+
+    layout = {}
+    if 'rigidBodies' in frame:
+        layout['rigidBodies'] = bodies
+    if 'markers' in frame:
+        layout['markers'] = markers
+    return layout, values, valid
+
+def layout_resolution(layout, params):
+    '''The resolution of each coded value of a frame with this layout.'''
+    resolution = []
+    position = params['positionResolution']
+    for body in layout.get('rigidBodies', ()):
+        for key in body['coded']:
+            if key in BODY_FIELDS:
+                length, name = BODY_FIELDS[key]
+                resolution.extend([params[name]] * (length or 1))
+        resolution.extend([position] * (3 * len(body.get('markers', ()))))
+    resolution.extend([position] * (3 * len(layout.get('markers', ()))))
+    return np.array(resolution, dtype=np.float64)
+
+def join_frame(frame, layout, values, valid):
+    '''Inverse of split_frame, adding the rigid bodies and markers to frame.'''
+    index = 0
+    if 'rigidBodies' in layout:
+        bodies = []
+        for i, body in enumerate(layout['rigidBodies']):
+            rb = dict((key, item) for key, item in body.items() if key not in ('coded', 'markers'))
+            for key in body['coded']:
+                if key == 'valid':
+                    rb['valid'] = bool(valid >> i & 1)
+                elif BODY_FIELDS[key][0] is None:
+                    rb[key] = values[index]
+                    index += 1
+                else:
+                    length = BODY_FIELDS[key][0]
+                    rb[key] = values[index:index+length]
+                    index += length
+            if 'markers' in body:
+                markers = []
+                for marker in body['markers']:
+                    marker = dict(marker)
+                    marker['position'] = values[index:index+3]
+                    index += 3
+                    markers.append(marker)
+                rb['markers'] = markers
+            bodies.append(rb)
+        frame['rigidBodies'] = bodies
+    if 'markers' in layout:
+        markers = []
+        for marker in layout['markers']:
+            marker = dict(marker)
+            marker['position'] = values[index:index+3]
+            index += 3
+            markers.append(marker)
+        frame['markers'] = markers
+    return frame
+
+def split_markers(layout, values):
+    '''Take the frame markers out of a layout and values from split_frame, returning them separately.'''
+    layout = dict(layout)
+    markers = layout.pop('markers', None)
+    count = len(values) - 3 * len(markers or ())
+    return layout, values[:count], markers, values[count:]
+
+class Mocap_Encoder(object):
+    '''Encodes the frames of one recording, in order.'''
+    def __init__(self, params):
+        self.params = params
+        self.layout = None
+        self.resolution = None
+        self.previous = None
+        self.markers = None
+        self.previous_markers = None
+        self.since_keyframe = 0
+        self.keyframes = 0
+        self.frames = 0
+        self.max_error = 0.0
+
+    def quantize(self, values, resolution):
+        quantized = np.rint(values / resolution).astype(np.int64)
+        if len(values):
+            self.max_error = max(self.max_error, float(np.abs(quantized * resolution - values).max()))
+        return quantized
+
+    def encode(self, frame):
+        '''Return a copy of frame with its rigidBodies and markers replaced by the coded mocap entry.'''
+        if not any(key in frame for key in MOCAP_KEYS):
+            return frame
+        layout, values, valid = split_frame(frame)
+        layout, values, markers, marker_values = split_markers(layout, np.array(values, dtype=np.float64))
+
+        keyframe = (layout != self.layout
+                    or self.since_keyframe >= self.params['keyframeInterval']
+                    or 'static' in frame)
+        if keyframe:
+            self.layout = layout
+            self.resolution = layout_resolution(layout, self.params)
+        quantized = self.quantize(values, self.resolution)
+
+        coded = dict((key, item) for key, item in frame.items() if key not in MOCAP_KEYS)
+        if keyframe:
+            coded['mocap'] = {'keyframe': layout, 'values': quantized.tolist(), 'valid': valid}
+            self.since_keyframe = 1
+            self.keyframes += 1
+        else:
+            coded['mocap'] = {'delta': (quantized - self.previous).tolist(), 'valid': valid}
+            self.since_keyframe += 1
+        self.previous = quantized
+
+        if markers is not None:
+            quantized = self.quantize(marker_values, self.params['positionResolution'])
+            if keyframe or markers != self.markers:
+                coded['mocap']['markers'] = {'layout': markers, 'values': quantized.tolist()}
+            else:
+                coded['mocap']['markers'] = {'delta': (quantized - self.previous_markers).tolist()}
+            self.previous_markers = quantized
+        self.markers = markers
+        self.frames += 1
+        return coded
+
+class Mocap_Decoder(object):
+    '''Decodes the frames of one recording, in order, starting at a keyframe.'''
+    def __init__(self, params):
+        if params.get('name') != CODEC_NAME:
+            raise ValueError("unknown codec %r" % params.get('name'))
+        self.params = params
+        self.layout = None
+        self.resolution = None
+        self.previous = None
+        self.markers = None
+        self.previous_markers = None
+
+    def decode(self, frame):
+        '''Return frame with its mocap entry replaced by the rigidBodies and markers.'''
+        mocap = frame.pop('mocap', None)
+        if mocap is None:
+            return frame
+        if 'keyframe' in mocap:
+            self.layout = mocap['keyframe']
+            self.resolution = layout_resolution(self.layout, self.params)
+            quantized = np.array(mocap['values'], dtype=np.int64)
+        elif self.previous is None:
+            raise ValueError("frame %s is a delta frame but no keyframe came before it" % frame.get('frame'))
+        else:
+            quantized = self.previous + np.array(mocap['delta'], dtype=np.int64)
+        self.previous = quantized
+        layout = self.layout
+        values = (quantized * self.resolution).tolist()
+
+        markers = mocap.get('markers')
+        if markers is not None:
+            if 'layout' in markers:
+                self.markers = markers['layout']
+                quantized = np.array(markers['values'], dtype=np.int64)
+            elif self.previous_markers is None:
+                raise ValueError("frame %s has marker deltas but no markers came before it" % frame.get('frame'))
+            else:
+                quantized = self.previous_markers + np.array(markers['delta'], dtype=np.int64)
+            self.previous_markers = quantized
+            layout = dict(layout, markers=self.markers)
+            values += (quantized * self.params['positionResolution']).tolist()
+        return join_frame(frame, layout, values, mocap['valid'])
+
+def is_keyframe(line):
+    '''Whether a raw frame line of a coded recording starts a run of frames that can be decoded on its own.'''
+    return '"keyframe"' in line
+
+def encode_recording(f, out, header, params):
+    '''
+    Encode the frames of the open recording f into out. Returns the encoder
+    and the largest difference between a decoded and an original value.
+    '''
+    header = dict(header, codec=params)
+    writer = Recording_Writer(out, header)
+    encoder = Mocap_Encoder(params)
+    decoder = Mocap_Decoder(params)
+    error = 0.0
+    for frame in iter_frames(f):
+        text = json.dumps(encoder.encode(frame))
+        writer.write(text)
+        # Check the reconstruction from the text actually written
+        decoded = decoder.decode(json.loads(text))
+        original, decoded = split_frame(frame)[1], split_frame(decoded)[1]
+        if original:
+            error = max(error, float(np.abs(np.subtract(decoded, original)).max()))
+    writer.close()
+    return encoder, error
+
+def decode_recording(f, out, header):
+    '''Decode the frames of the open coded recording f into out.'''
+    header = dict(header)
+    decoder = Mocap_Decoder(header.pop('codec'))
+    writer = Recording_Writer(out, header)
+    for frame in iter_frames(f):
+        writer.write(json.dumps(decoder.decode(frame)))
+    writer.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='python codec.py',
+        description='''
+            Encodes the mocap data of a recording made by capture.py with
+            the delta and quantization codec, or decodes a coded
+            recording.''')
+    parser.add_argument("command",
+                        choices=('encode', 'decode'),
+                        help="encode or decode the recording.")
+    parser.add_argument("recording",
+                        help="path to the recording.")
+    parser.add_argument("--output",
+                        default="coded.json",
+                        help="path to output file. (default: coded.json)")
+    parser.add_argument("--position-resolution",
+                        default=1e-5,
+                        type=float,
+                        help="resolution of positions in m. (default: 1e-5)")
+    parser.add_argument("--rotation-resolution",
+                        default=1e-6,
+                        type=float,
+                        help="resolution of quaternion components. (default: 1e-6)")
+    parser.add_argument("--keyframe-interval",
+                        default=100,
+                        type=int,
+                        help="number of frames from one keyframe to the next. (default: 100)")
+    args = parser.parse_args()
+
+    f, header = open_recording(args.recording)
+    with f, open(args.output, 'w') as out:
+        if args.command == 'decode':
+            decode_recording(f, out, header)
+        else:
+            params = codec_params(args.position_resolution, args.rotation_resolution, args.keyframe_interval)
+            encoder, error = encode_recording(f, out, header, params)
+
+    if args.command == 'encode':
+        size = os.path.getsize(args.recording)
+        coded_size = os.path.getsize(args.output)
+        print( 'frames: %d, keyframes: %d' % (encoder.frames, encoder.keyframes) )
+        print( 'size: %d -> %d bytes, compression ratio %.2f' % (size, coded_size, float(size) / coded_size) )
+        print( 'largest reconstruction error: %g' % error )
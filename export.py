@@ -0,0 +1,348 @@
+'''
+Exports a recording made by capture.py to Apache Parquet tables.
+
+The nested frames are flattened into typed columnar tables, one file each in
+the output directory:
+
+rigid_bodies.parquet  rigid body poses, in long form one row per body and
+                      frame (frame, time, id, name, valid, markerError, x,
+                      y, z, qx, qy, qz, qw and the filtered pose when the
+                      recording has one), or in wide form one row per
+                      frame with the columns of every body prefixed by its
+                      name
+markers.parquet       one row per marker and frame (frame, time, labeled,
+                      id, x, y, z, size)
+pupil0.parquet        one row per frame with the pupil sample of each eye
+pupil1.parquet
+
+The file is read in chunks of frames which are flattened in parallel by a
+process pool. Every chunk becomes one Parquet row group, except in the long
+rigid body table, where every body of a chunk gets a row group of its own.
+The row group statistics then let readers skip straight to one body or
+time range, and the page index written with every file narrows a time
+range down further within a row group:
+
+    pandas.read_parquet('out/rigid_bodies.parquet', filters=[('id', '==', 2)])
+
+The recording's header is stored as json in the schema metadata of every
+table under the key "recording". Recordings made with the codec (see
+codec.py) are decoded, their chunks start at a keyframe so every chunk can
+be decoded on its own.
+
+This needs pyarrow.
+'''
+
+import argparse
+import json
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby, islice
+
+from recording import open_recording, decode_frame
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Pupil sample fields exported as columns: (column, path in the sample, type)
+PUPIL_FIELDS = [
+    ('timestamp', ('timestamp',), 'float64'),
+    ('confidence', ('confidence',), 'float64'),
+    ('norm_pos_x', ('norm_pos', 0), 'float64'),
+    ('norm_pos_y', ('norm_pos', 1), 'float64'),
+    ('diameter', ('diameter',), 'float64'),
+    ('ellipse_center_x', ('ellipse', 'center', 0), 'float64'),
+    ('ellipse_center_y', ('ellipse', 'center', 1), 'float64'),
+    ('ellipse_axis_a', ('ellipse', 'axes', 0), 'float64'),
+    ('ellipse_axis_b', ('ellipse', 'axes', 1), 'float64'),
+    ('ellipse_angle', ('ellipse', 'angle'), 'float64'),
+    ('diameter_3d', ('diameter_3d',), 'float64'),
+    ('model_confidence', ('model_confidence',), 'float64'),
+    ('theta', ('theta',), 'float64'),
+    ('phi', ('phi',), 'float64'),
+    ('sphere_center_x', ('sphere', 'center', 0), 'float64'),
+    ('sphere_center_y', ('sphere', 'center', 1), 'float64'),
+    ('sphere_center_z', ('sphere', 'center', 2), 'float64'),
+    ('sphere_radius', ('sphere', 'radius'), 'float64'),
+    ('circle_3d_center_x', ('circle_3d', 'center', 0), 'float64'),
+    ('circle_3d_center_y', ('circle_3d', 'center', 1), 'float64'),
+    ('circle_3d_center_z', ('circle_3d', 'center', 2), 'float64'),
+    ('circle_3d_normal_x', ('circle_3d', 'normal', 0), 'float64'),
+    ('circle_3d_normal_y', ('circle_3d', 'normal', 1), 'float64'),
+    ('circle_3d_normal_z', ('circle_3d', 'normal', 2), 'float64'),
+    ('circle_3d_radius', ('circle_3d', 'radius'), 'float64'),
+    ('method', ('method',), 'string') ]
+
+POSE_COLUMNS = ('x', 'y', 'z', 'qx', 'qy', 'qz', 'qw')
+FILTERED_POSE_COLUMNS = ('fx', 'fy', 'fz', 'fqx', 'fqy', 'fqz', 'fqw')
+
+def _lookup(sample, path):
+    for key in path:
+        try:
+            sample = sample[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return sample
+
+def _pose(rb, filtered):
+    if filtered:
+        position, rotation = rb.get('filteredPosition'), rb.get('filteredRotation')
+    else:
+        position, rotation = rb.get('position'), rb.get('rotation')
+    if position is None or rotation is None:
+        return (None,) * 7
+    return tuple(position) + tuple(rotation)
+
+def body_names(descriptions, names=None):
+    '''Map rigid body ids to names from a list of rigid body descriptions.'''
+    names = dict(names or {})
+    for description in descriptions or []:
+        names[description['id']] = description.get('name', 'body%d' % description['id'])
+    return names
+
+def schemas(header, rigid_bodies):
+    '''The schema of every table exported from a recording with this header.'''
+    filtered = 'poseFilter' in header
+    pose_columns = POSE_COLUMNS + (FILTERED_POSE_COLUMNS if filtered else ())
+    metadata = {'recording': json.dumps(header)}
+
+    if rigid_bodies == 'long':
+        fields = [('frame', pa.int64()), ('time', pa.float64()), ('id', pa.int32()),
+                  ('name', pa.string()), ('valid', pa.bool_()), ('markerError', pa.float64())]
+        fields += [(column, pa.float64()) for column in pose_columns]
+    else:
+        fields = [('frame', pa.int64()), ('time', pa.float64())]
+        names = body_names(header.get('rigidBodyInfo'))
+        for id in sorted(names):
+            fields.append(('%s_valid' % names[id], pa.bool_()))
+            fields.append(('%s_markerError' % names[id], pa.float64()))
+            fields += [('%s_%s' % (names[id], column), pa.float64()) for column in pose_columns]
+
+    tables = {
+        'rigid_bodies': pa.schema(fields, metadata=metadata),
+        'markers': pa.schema([
+            ('frame', pa.int64()), ('time', pa.float64()), ('labeled', pa.bool_()), ('id', pa.int32()),
+            ('x', pa.float64()), ('y', pa.float64()), ('z', pa.float64()), ('size', pa.float64())],
+            metadata=metadata) }
+    pupil = pa.schema([('frame', pa.int64()), ('time', pa.float64())] +
+                      [(column, pa.type_for_alias(type)) for column, path, type in PUPIL_FIELDS],
+                      metadata=metadata)
+    tables['pupil0'] = pupil
+    tables['pupil1'] = pupil
+    return tables
+
+def export_chunk(lines, header, names, rigid_bodies):
+    '''
+    Flatten the frames of one chunk of recording lines into pyarrow Tables,
+    a list of them per output table, each to be written as a row group.
+    names maps rigid body ids to names at the start of the chunk. Returns
+    the tables and the ids of bodies left out of the wide table because the
+    header doesn't describe them.
+    '''
+    tables = schemas(header, rigid_bodies)
+    filtered = 'poseFilter' in header
+    wide_names = body_names(header.get('rigidBodyInfo'))
+    columns = dict((table, dict((name, []) for name in schema.names)) for table, schema in tables.items())
+    unknown = set()
+
+    decoder = None
+    if 'codec' in header:
+        from codec import Mocap_Decoder
+        decoder = Mocap_Decoder(header['codec'])
+
+    for line in lines:
+        frame = decode_frame(line)
+        if frame is None:
+            continue
+        if decoder is not None:
+            frame = decoder.decode(frame)
+        number, time = frame['frame'], frame['time']
+
+        # Model definitions changed while recording
+        static = frame.get('static')
+        if static and 'rigidBodyInfo' in static:
+            names = body_names(static['rigidBodyInfo'], names)
+
+        rows = columns['rigid_bodies']
+        if rigid_bodies == 'long':
+            for rb in frame.get('rigidBodies', ()):
+                rows['frame'].append(number)
+                rows['time'].append(time)
+                rows['id'].append(rb['id'])
+                rows['name'].append(names.get(rb['id']))
+                rows['valid'].append(rb.get('valid'))
+                rows['markerError'].append(rb.get('markerError'))
+                for column, value in zip(POSE_COLUMNS, _pose(rb, False)):
+                    rows[column].append(value)
+                if filtered:
+                    for column, value in zip(FILTERED_POSE_COLUMNS, _pose(rb, True)):
+                        rows[column].append(value)
+        elif 'rigidBodies' in frame:
+            row = dict.fromkeys(rows)
+            row['frame'] = number
+            row['time'] = time
+            for rb in frame['rigidBodies']:
+                name = wide_names.get(rb['id'])
+                if name is None:
+                    unknown.add(rb['id'])
+                    continue
+                row['%s_valid' % name] = rb.get('valid')
+                row['%s_markerError' % name] = rb.get('markerError')
+                for column, value in zip(POSE_COLUMNS, _pose(rb, False)):
+                    row['%s_%s' % (name, column)] = value
+                if filtered:
+                    for column, value in zip(FILTERED_POSE_COLUMNS, _pose(rb, True)):
+                        row['%s_%s' % (name, column)] = value
+            for column, value in row.items():
+                rows[column].append(value)
+
+        rows = columns['markers']
+        for marker in frame.get('markers', ()):
+            position = marker['position']
+            size = marker.get('size')
+            rows['frame'].append(number)
+            rows['time'].append(time)
+            rows['labeled'].append(marker.get('labeled'))
+            rows['id'].append(marker.get('id'))
+            rows['x'].append(position[0])
+            rows['y'].append(position[1])
+            rows['z'].append(position[2])
+            rows['size'].append(size[0] if size else None)
+
+        for eye in ('pupil0', 'pupil1'):
+            sample = frame.get(eye)
+            if sample is None:
+                continue
+            rows = columns[eye]
+            rows['frame'].append(number)
+            rows['time'].append(time)
+            for column, path, type in PUPIL_FIELDS:
+                rows[column].append(_lookup(sample, path))
+
+    result = {}
+    for table, schema in tables.items():
+        if columns[table]['frame']:
+            result[table] = [pa.Table.from_pydict(columns[table], schema=schema)]
+    if rigid_bodies == 'long' and 'rigid_bodies' in result:
+        result['rigid_bodies'] = split_by_id(result['rigid_bodies'][0])
+    return result, unknown
+
+def split_by_id(table):
+    '''Sort a long rigid body table by id and frame and split it into one table per id.'''
+    table = table.sort_by([('id', 'ascending'), ('frame', 'ascending')])
+    parts = []
+    start = 0
+    for id, rows in groupby(table.column('id').to_pylist()):
+        length = len(list(rows))
+        parts.append(table.slice(start, length))
+        start += length
+    return parts
+
+def iter_chunks(f, chunk_size, coded=False):
+    '''
+    Yield lists of chunk_size lines of an open recording. The chunks of
+    coded recordings are extended up to the next keyframe.
+    '''
+    if not coded:
+        while True:
+            lines = list(islice(f, chunk_size))
+            if not lines:
+                return
+            yield lines
+
+    from codec import is_keyframe
+    lines = []
+    for line in f:
+        if len(lines) >= chunk_size and is_keyframe(line):
+            yield lines
+            lines = []
+        lines.append(line)
+    if lines:
+        yield lines
+
+def export(path, output_dir, rigid_bodies='long', chunk_size=2000, workers=None):
+    '''Export the recording at path to Parquet files in output_dir. Returns the number of rows of each table.'''
+    if pa is None:
+        raise ImportError("exporting to Parquet needs pyarrow, install it with: pip install pyarrow")
+
+    f, header = open_recording(path)
+    os.makedirs(output_dir, exist_ok=True)
+    tables = schemas(header, rigid_bodies)
+    writers = {}
+    rows = dict.fromkeys(tables, 0)
+    unknown = set()
+    names = body_names(header.get('rigidBodyInfo'))
+
+    def write(future):
+        result, chunk_unknown = future.result()
+        unknown.update(chunk_unknown)
+        for table, groups in result.items():
+            if table not in writers:
+                writers[table] = pq.ParquetWriter(os.path.join(output_dir, table + '.parquet'), tables[table],
+                                                  write_page_index=True)
+            for data in groups:
+                writers[table].write_table(data, row_group_size=len(data))
+                rows[table] += len(data)
+
+    workers = workers or os.cpu_count() or 1
+    with f, ProcessPoolExecutor(workers) as executor:
+        # Keep a few chunks in flight per worker and write them in order
+        in_flight = deque()
+        for lines in iter_chunks(f, chunk_size, 'codec' in header):
+            in_flight.append(executor.submit(export_chunk, lines, header, names, rigid_bodies))
+            # Only frames with model definition changes are decoded here, for the names of the next chunks
+            for line in lines:
+                if '"static"' in line:
+                    # The text can also be part of another value, e.g. an event name
+                    frame = decode_frame(line)
+                    static = frame.get('static') if frame is not None else None
+                    if static and 'rigidBodyInfo' in static:
+                        names = body_names(static['rigidBodyInfo'], names)
+            if len(in_flight) >= 2 * workers:
+                write(in_flight.popleft())
+        while in_flight:
+            write(in_flight.popleft())
+
+    for writer in writers.values():
+        writer.close()
+    if unknown:
+        print( 'Rigid bodies %s are not in the header and were left out of the wide table' %
+               ', '.join(str(id) for id in sorted(unknown)) )
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='python export.py',
+        description='''
+            Exports a recording made by capture.py to Parquet tables for
+            pandas, polars or any other Arrow reader.''')
+    parser.add_argument("recording",
+                        help="path to the recording.")
+    parser.add_argument("--output-dir",
+                        help="directory for the Parquet files. (default: the recording's name)")
+    parser.add_argument("--rigid-bodies",
+                        choices=('long', 'wide'),
+                        default='long',
+                        help="one row per rigid body and frame (long) or one row per frame (wide). (default: long)")
+    parser.add_argument("--chunk-size",
+                        default=2000,
+                        type=int,
+                        help="number of frames per chunk and Parquet row group. (default: 2000)")
+    parser.add_argument("--workers",
+                        type=int,
+                        help="number of worker processes. (default: number of cores)")
+    args = parser.parse_args()
+
+    if pa is None:
+        print( 'export.py needs pyarrow, install it with: pip install pyarrow' )
+        sys.exit(1)
+
+    output_dir = args.output_dir or os.path.splitext(args.recording)[0]
+    rows = export(args.recording, output_dir, args.rigid_bodies, args.chunk_size, args.workers)
+    for table, count in rows.items():
+        if count:
+            print( '%s: %d rows' % (os.path.join(output_dir, table + '.parquet'), count) )
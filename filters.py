@@ -0,0 +1,210 @@
+'''
+Online filtering of rigid body poses.
+
+Pose_Filter keeps the state of every rigid body in NumPy arrays so a frame
+is filtered with one vectorised update for all bodies. Positions are
+smoothed with a One-Euro filter or a constant-velocity Kalman filter,
+rotations with a One-Euro style adaptive quaternion lerp.
+
+Frames where a body's tracking is not valid do not update its state. During
+such a gap the Kalman filter keeps predicting from the last velocity and the
+One-Euro filter holds the last estimate. After max_gap seconds without a
+valid sample the body's state is dropped and restarts from the next valid
+sample.
+
+Set an instance as NatNetClient.poseFilter to add filteredPosition and
+filteredRotation to the rigid bodies of each frame. Bodies without a
+filter state (never valid yet, or dropped after max_gap) get neither.
+'''
+
+import numpy as np
+
+def _smoothing_factor(dt, cutoff):
+    r = 2.0 * np.pi * cutoff * dt
+    return r / (r + 1.0)
+
+class Pose_Filter(object):
+    def __init__(self, method='one-euro', min_cutoff=1.0, beta=20.0, d_cutoff=1.0,
+                 rotation_min_cutoff=1.0, rotation_beta=0.5,
+                 process_noise=50.0, measurement_noise=1e-6, max_gap=0.5):
+        '''
+        method is 'one-euro' or 'kalman' for positions.
+        min_cutoff (Hz), beta (per m/s) and d_cutoff (Hz) are the One-Euro
+        parameters for positions, rotation_min_cutoff and rotation_beta
+        (per rad/s) the ones for rotations.
+        process_noise (acceleration variance, m^2/s^4) and measurement_noise
+        (m^2) are the Kalman parameters.
+        '''
+        if method not in ('one-euro', 'kalman'):
+            raise ValueError("unknown filter method %r" % method)
+        self.method = method
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.rotation_min_cutoff = rotation_min_cutoff
+        self.rotation_beta = rotation_beta
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.max_gap = max_gap
+
+        self.slots = {}
+        self._ids = None
+        self._index = None
+        self._last_time = None
+        self._allocate(0)
+
+    def _allocate(self, capacity):
+        '''Grow the state arrays to hold capacity bodies, keeping existing state.'''
+        def grow(name, shape, fill=0.0, dtype=np.float64):
+            old = getattr(self, name, None)
+            new = np.full((capacity,) + shape, fill, dtype=dtype)
+            if old is not None:
+                new[:len(old)] = old
+            setattr(self, name, new)
+
+        grow('position', (3,))
+        grow('velocity', (3,))
+        grow('rotation', (4,))
+        grow('angular_speed', ())
+        grow('covariance', (2, 2))
+        grow('last_valid', (), -np.inf)
+        grow('initialized', (), False, bool)
+
+    def _slots_for(self, ids):
+        '''Array of state rows for the body ids, allocating rows for new ids.'''
+        if ids == self._ids:
+            return self._index
+        for id in ids:
+            if id not in self.slots:
+                self.slots[id] = len(self.slots)
+        if len(self.slots) > len(self.position):
+            self._allocate(max(len(self.slots), 2 * len(self.position)))
+        self._ids = ids
+        self._index = np.array([self.slots[id] for id in ids], dtype=np.intp)
+        return self._index
+
+    def reset(self):
+        '''Forget the state of all bodies.'''
+        self.initialized[:] = False
+        self._last_time = None
+
+    def update(self, ids, positions, rotations, valid, timestamp):
+        '''
+        Filter one frame. ids is a tuple of body ids, positions (M, 3),
+        rotations (M, 4) as x, y, z, w and valid (M,) the raw values and
+        tracking flags of those bodies, timestamp the frame time in seconds.
+        Returns the filtered positions (M, 3) and rotations (M, 4) and
+        whether each body has a filter state (M,). The rows of bodies
+        without one hold no estimate.
+        '''
+        index = self._slots_for(ids)
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        rotations = np.asarray(rotations, dtype=np.float64).reshape(-1, 4)
+        valid = np.asarray(valid, dtype=bool)
+
+        dt = 0.0 if self._last_time is None else timestamp - self._last_time
+        self._last_time = timestamp
+
+        # Drop bodies that have been invalid for too long
+        initialized = self.initialized[index]
+        initialized &= (timestamp - self.last_valid[index]) <= self.max_gap
+
+        # Bodies seen for the first time (or after a long gap) start at the measurement
+        start = valid & ~initialized
+        if start.any():
+            rows = index[start]
+            self.position[rows] = positions[start]
+            self.velocity[rows] = 0.0
+            self.rotation[rows] = rotations[start]
+            self.angular_speed[rows] = 0.0
+            self.covariance[rows] = np.diag((self.measurement_noise, 1.0))
+
+        step = valid & initialized
+        if dt > 0:
+            if self.method == 'kalman':
+                self._kalman(index[initialized], positions[initialized], step[initialized], dt)
+            elif step.any():
+                self._one_euro(index[step], positions[step], dt)
+            if step.any():
+                self._rotation(index[step], rotations[step], dt)
+
+        self.last_valid[index[valid]] = timestamp
+        initialized |= start
+        self.initialized[index] = initialized
+
+        return self.position[index], self.rotation[index], initialized
+
+    def _one_euro(self, rows, positions, dt):
+        previous = self.position[rows]
+        speed = (positions - previous) / dt
+        a_d = _smoothing_factor(dt, self.d_cutoff)
+        velocity = a_d * speed + (1.0 - a_d) * self.velocity[rows]
+        cutoff = self.min_cutoff + self.beta * np.linalg.norm(velocity, axis=1)
+        a = _smoothing_factor(dt, cutoff)[:, None]
+        self.position[rows] = a * positions + (1.0 - a) * previous
+        self.velocity[rows] = velocity
+
+    def _kalman(self, rows, positions, measured, dt):
+        # Predict every active body with the constant velocity model. The
+        # covariance is the same for all three axes so it is kept as 2x2.
+        P = self.covariance[rows]
+        q = self.process_noise
+        P00 = P[:, 0, 0] + dt * (P[:, 0, 1] + P[:, 1, 0]) + dt * dt * P[:, 1, 1] + q * dt ** 4 / 4.0
+        P01 = P[:, 0, 1] + dt * P[:, 1, 1] + q * dt ** 3 / 2.0
+        P11 = P[:, 1, 1] + q * dt * dt
+        position = self.position[rows] + self.velocity[rows] * dt
+        velocity = self.velocity[rows]
+
+        # Correct the bodies that have a valid measurement
+        S = P00 + self.measurement_noise
+        K0 = np.where(measured, P00 / S, 0.0)
+        K1 = np.where(measured, P01 / S, 0.0)
+        innovation = np.where(measured[:, None], positions - position, 0.0)
+        position = position + K0[:, None] * innovation
+        velocity = velocity + K1[:, None] * innovation
+        P11 = P11 - K1 * P01
+        P01 = (1.0 - K0) * P01
+        P00 = (1.0 - K0) * P00
+
+        self.position[rows] = position
+        self.velocity[rows] = velocity
+        self.covariance[rows] = np.stack((np.stack((P00, P01), -1), np.stack((P01, P11), -1)), -2)
+
+    def _rotation(self, rows, rotations, dt):
+        previous = self.rotation[rows]
+        # q and -q are the same rotation, interpolate towards the closer one
+        dot = np.einsum('ij,ij->i', previous, rotations)
+        rotations = np.where((dot < 0)[:, None], -rotations, rotations)
+        angle = 2.0 * np.arccos(np.clip(np.abs(dot), 0.0, 1.0))
+        a_d = _smoothing_factor(dt, self.d_cutoff)
+        speed = a_d * (angle / dt) + (1.0 - a_d) * self.angular_speed[rows]
+        cutoff = self.rotation_min_cutoff + self.rotation_beta * speed
+        a = _smoothing_factor(dt, cutoff)[:, None]
+        rotation = a * rotations + (1.0 - a) * previous
+        self.rotation[rows] = rotation / np.linalg.norm(rotation, axis=1)[:, None]
+        self.angular_speed[rows] = speed
+
+    def apply(self, rigidBodies, timestamp):
+        '''
+        Filter the rigid body dicts of one NatNetClient frame, adding
+        filteredPosition and filteredRotation to each body with a filter
+        state and removing them from the others.
+        '''
+        bodies = [rb for rb in rigidBodies if 'position' in rb]
+        if not bodies:
+            return
+        ids = tuple(rb['id'] for rb in bodies)
+        position, rotation, initialized = self.update(
+            ids,
+            [rb['position'] for rb in bodies],
+            [rb['rotation'] for rb in bodies],
+            [rb.get('valid', True) for rb in bodies],
+            timestamp)
+        for rb, p, r, has_state in zip(bodies, position.tolist(), rotation.tolist(), initialized.tolist()):
+            if has_state:
+                rb['filteredPosition'] = p
+                rb['filteredRotation'] = r
+            else:
+                # NatNetClient reuses the dicts, drop the estimate of an earlier frame
+                rb.pop('filteredPosition', None)
+                rb.pop('filteredRotation', None)
@@ -0,0 +1,193 @@
+'''
+Gaze-in-world computation from a head rigid body and Pupil Labs pupil data.
+
+A calibration file describes which OptiTrack rigid body is worn on the head,
+where each eye sits relative to that rigid body and how a pupil's norm_pos
+maps to a gaze direction:
+
+{
+    "headRigidBodyId": 1,
+    "minConfidence": 0.6,
+    "eyes": {
+        "pupil0": {
+            "position": [0.032, -0.04, 0.06],
+            "rotation": [0.0, 0.0, 0.0, 1.0],
+            "mapping": {"yaw": [c0, c1, c2, c3, c4, c5],
+                        "pitch": [c0, c1, c2, c3, c4, c5]}
+        },
+        "pupil1": {...}
+    }
+}
+
+position and rotation (x, y, z, w quaternion like NatNet) transform the eye
+frame into the head rigid body frame. The mapping gives the gaze yaw and
+pitch in radians as polynomials in norm_pos (x, y) with the terms
+1, x, y, x*y, x*x, y*y. The eye frame looks along +z with +y up, so zero
+yaw and pitch is straight ahead.
+
+All computations work on batches of frames at once using NumPy.
+'''
+
+import argparse
+import json
+import numpy as np
+
+from recording import open_recording, iter_batches, Recording_Writer
+
+def quaternion_rotate(q, v):
+    '''Rotate vectors v (N, 3) by quaternions q (N, 4) given as x, y, z, w.'''
+    u = q[..., :3]
+    w = q[..., 3:]
+    t = 2.0 * np.cross(u, v)
+    return v + w * t + np.cross(u, t)
+
+def quaternion_multiply(a, b):
+    '''Hamilton product of quaternions a and b (..., 4) given as x, y, z, w.'''
+    ax, ay, az, aw = np.moveaxis(a, -1, 0)
+    bx, by, bz, bw = np.moveaxis(b, -1, 0)
+    return np.stack((
+        aw * bx + ax * bw + ay * bz - az * by,
+        aw * by - ax * bz + ay * bw + az * bx,
+        aw * bz + ax * by - ay * bx + az * bw,
+        aw * bw - ax * bx - ay * by - az * bz), axis=-1)
+
+class Eye_Calibration(object):
+    '''Eye to head transform and norm_pos to gaze direction mapping for one eye.'''
+    def __init__(self, position, rotation, mapping):
+        self.position = np.asarray(position, dtype=np.float64)
+        self.rotation = np.asarray(rotation, dtype=np.float64)
+        self.rotation /= np.linalg.norm(self.rotation)
+        self.yaw = np.asarray(mapping['yaw'], dtype=np.float64)
+        self.pitch = np.asarray(mapping['pitch'], dtype=np.float64)
+
+    def directions(self, norm_pos):
+        '''Gaze directions (N, 3) in the eye frame for norm_pos (N, 2).'''
+        x = norm_pos[:, 0]
+        y = norm_pos[:, 1]
+        terms = np.stack((np.ones_like(x), x, y, x * y, x * x, y * y), axis=-1)
+        yaw = terms @ self.yaw
+        pitch = terms @ self.pitch
+        cos_pitch = np.cos(pitch)
+        return np.stack((np.sin(yaw) * cos_pitch, np.sin(pitch), np.cos(yaw) * cos_pitch), axis=-1)
+
+class Gaze_Mapper(object):
+    '''
+    Computes gaze rays in world coordinates.
+    map_batch works on arrays, map_frames on lists of recorded frames.
+    '''
+    def __init__(self, calibration):
+        self.head_id = calibration['headRigidBodyId']
+        self.min_confidence = calibration.get('minConfidence', 0.0)
+        self.eyes = {}
+        for name, eye in calibration['eyes'].items():
+            self.eyes[name] = Eye_Calibration(eye['position'], eye['rotation'], eye['mapping'])
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def map_batch(self, head_position, head_rotation, head_valid, norm_pos, confidence):
+        '''
+        head_position (N, 3), head_rotation (N, 4) and head_valid (N,) describe
+        the head rigid body, norm_pos and confidence are dicts of eye name to
+        (N, 2) and (N,) arrays. Returns a dict of eye name to
+        (origin (N, 3), direction (N, 3), valid (N,)) in world coordinates.
+        '''
+        rays = {}
+        for name, eye in self.eyes.items():
+            if name not in norm_pos:
+                continue
+            origin = head_position + quaternion_rotate(head_rotation, np.broadcast_to(eye.position, head_position.shape))
+            to_world = quaternion_multiply(head_rotation, eye.rotation)
+            direction = quaternion_rotate(to_world, eye.directions(norm_pos[name]))
+            valid = head_valid & (confidence[name] >= self.min_confidence)
+            rays[name] = (origin, direction, valid)
+        return rays
+
+    def map_frames(self, frames):
+        '''
+        Compute gaze rays for a list of recorded frames. Returns one dict per
+        frame with a gaze0 / gaze1 entry per calibrated eye, ready to be added
+        to the frame.
+        '''
+        count = len(frames)
+        head_position = np.zeros((count, 3))
+        head_rotation = np.zeros((count, 4))
+        head_rotation[:, 3] = 1.0
+        head_valid = np.zeros(count, dtype=bool)
+        norm_pos = {}
+        confidence = {}
+        for name in self.eyes:
+            norm_pos[name] = np.zeros((count, 2))
+            confidence[name] = np.full(count, -1.0)
+
+        for i, frame in enumerate(frames):
+            for rb in frame.get('rigidBodies', ()):
+                if rb['id'] == self.head_id and 'position' in rb:
+                    # Use the filtered pose when the recorder filters poses
+                    head_position[i] = rb.get('filteredPosition', rb['position'])
+                    head_rotation[i] = rb.get('filteredRotation', rb['rotation'])
+                    head_valid[i] = rb.get('valid', True)
+                    break
+            for name in self.eyes:
+                pupil = frame.get(name)
+                if pupil is not None:
+                    norm_pos[name][i] = pupil['norm_pos']
+                    confidence[name][i] = pupil['confidence']
+
+        rays = self.map_batch(head_position, head_rotation, head_valid, norm_pos, confidence)
+
+        fields = [{} for i in range(count)]
+        for name, (origin, direction, valid) in rays.items():
+            key = name.replace('pupil', 'gaze')
+            origin = origin.tolist()
+            direction = direction.tolist()
+            valid = valid.tolist()
+            for i in range(count):
+                fields[i][key] = {
+                    'origin': origin[i],
+                    'direction': direction[i],
+                    'valid': valid[i] }
+        return fields
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='python gaze.py',
+        description='''
+            Adds gaze-in-world rays to a recording made by capture.py.''')
+    parser.add_argument("recording",
+                        help="path to the recording.")
+    parser.add_argument("calibration",
+                        help="path to the gaze calibration file.")
+    parser.add_argument("--output",
+                        default="gaze.json",
+                        help="path to output file. (default: gaze.json)")
+    parser.add_argument("--batch-size",
+                        default=1000,
+                        type=int,
+                        help="number of frames computed at once. (default: 1000)")
+    args = parser.parse_args()
+
+    with open(args.calibration) as f:
+        calibration = json.load(f)
+    mapper = Gaze_Mapper(calibration)
+
+    f, header = open_recording(args.recording)
+    header['gazeCalibration'] = calibration
+
+    # Coded recordings are written out decoded
+    decoder = None
+    if 'codec' in header:
+        from codec import Mocap_Decoder
+        decoder = Mocap_Decoder(header.pop('codec'))
+
+    with f, open(args.output, 'w') as out:
+        writer = Recording_Writer(out, header)
+        for frames in iter_batches(f, args.batch_size):
+            if decoder is not None:
+                frames = [decoder.decode(frame) for frame in frames]
+            for frame, fields in zip(frames, mapper.map_frames(frames)):
+                frame.update(fields)
+                writer.write(json.dumps(frame))
+        writer.close()
@@ -0,0 +1,278 @@
+'''
+Online data quality metrics for recordings.
+
+Quality_Monitor is fed every recorded frame and keeps, over a rolling
+window of the last window seconds:
+
+* the mean and max marker error of every rigid body,
+* the percentage of frames every rigid body was tracked (valid),
+* the confidence distribution of every eye (a histogram with 10 bins),
+* the rate of low-confidence runs per eye, a run being consecutive
+  samples below the low confidence threshold.
+
+Every sample updates the metrics in amortized O(1): sums and counts are updated as
+samples enter and leave the window, and the max comes from a monotonic
+deque. The windows keep every sample they cover, so their memory grows with
+the window length and the sample rate: 2400 samples per rigid body and eye
+at 240 Hz with a 10 second window. It also keeps totals for the whole
+session, which summary() returns as a compact dict for the recording header.
+
+Alarm thresholds are checked against the rolling metrics with
+check_alarms(), 0 turns an alarm off.
+'''
+
+from collections import deque
+
+EYES = ('pupil0', 'pupil1')
+CONFIDENCE_BINS = 10
+
+class Rolling_Window(object):
+    '''Count, mean and max of the values added in the last window seconds.'''
+    def __init__(self, window):
+        self.window = window
+        self.samples = deque()
+        self.maxima = deque()
+        self.total = 0.0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, time, value):
+        self.samples.append((time, value))
+        self.total += value
+        # Older values that are not larger can never be the max again
+        while self.maxima and self.maxima[-1][1] <= value:
+            self.maxima.pop()
+        self.maxima.append((time, value))
+        self.expire(time)
+
+    def expire(self, now):
+        limit = now - self.window
+        while self.samples and self.samples[0][0] < limit:
+            self.total -= self.samples.popleft()[1]
+        while self.maxima and self.maxima[0][0] < limit:
+            self.maxima.popleft()
+        if not self.samples:
+            # Start again from exactly 0 so rounding errors don't build up
+            self.total = 0.0
+
+    @property
+    def mean(self):
+        return self.total / len(self.samples) if self.samples else None
+
+    @property
+    def max(self):
+        return self.maxima[0][1] if self.maxima else None
+
+def confidence_bin(value):
+    '''Histogram bin of a value between 0 and 1.'''
+    return min(CONFIDENCE_BINS - 1, max(0, int(value * CONFIDENCE_BINS)))
+
+class Rolling_Histogram(object):
+    '''Histogram of the values between 0 and 1 added in the last window seconds.'''
+    def __init__(self, window):
+        self.window = window
+        self.samples = deque()
+        self.counts = [0] * CONFIDENCE_BINS
+
+    def add(self, time, value):
+        bin = confidence_bin(value)
+        self.samples.append((time, bin))
+        self.counts[bin] += 1
+        self.expire(time)
+
+    def expire(self, now):
+        limit = now - self.window
+        while self.samples and self.samples[0][0] < limit:
+            self.counts[self.samples.popleft()[1]] -= 1
+
+class Body_Quality(object):
+    def __init__(self, window):
+        self.marker_error = Rolling_Window(window)
+        self.valid = Rolling_Window(window)
+        self.frames = 0
+        self.valid_samples = 0
+        self.valid_frames = 0
+        self.error_samples = 0
+        self.error_total = 0.0
+        self.error_max = 0.0
+
+    def add(self, time, rb):
+        self.frames += 1
+        if 'valid' in rb:
+            self.valid.add(time, 1.0 if rb['valid'] else 0.0)
+            self.valid_samples += 1
+            if rb['valid']:
+                self.valid_frames += 1
+        # The marker error of a body that isn't tracked is meaningless
+        if 'markerError' in rb and rb.get('valid', True):
+            error = rb['markerError']
+            self.marker_error.add(time, error)
+            self.error_samples += 1
+            self.error_total += error
+            self.error_max = max(self.error_max, error)
+
+    def expire(self, now):
+        self.marker_error.expire(now)
+        self.valid.expire(now)
+
+    def summary(self):
+        summary = {'frames': self.frames}
+        if self.error_samples:
+            summary['meanMarkerError'] = round(self.error_total / self.error_samples, 7)
+            summary['maxMarkerError'] = round(self.error_max, 7)
+        if self.valid_samples:
+            summary['validPercent'] = round(100.0 * self.valid_frames / self.valid_samples, 2)
+        return summary
+
+class Eye_Quality(object):
+    def __init__(self, window, low_confidence):
+        self.low_confidence = low_confidence
+        self.confidence = Rolling_Window(window)
+        self.histogram = Rolling_Histogram(window)
+        self.run_starts = Rolling_Window(window)
+        self.in_run = False
+        self.run_start = None
+        self.samples = 0
+        self.low_samples = 0
+        self.confidence_total = 0.0
+        self.session_histogram = [0] * CONFIDENCE_BINS
+        self.runs = 0
+        self.longest_run = 0.0
+
+    def add(self, time, confidence):
+        self.confidence.add(time, confidence)
+        self.histogram.add(time, confidence)
+        self.samples += 1
+        self.confidence_total += confidence
+        self.session_histogram[confidence_bin(confidence)] += 1
+
+        low = confidence < self.low_confidence
+        if low:
+            self.low_samples += 1
+            if not self.in_run:
+                self.run_start = time
+                self.runs += 1
+                self.run_starts.add(time, 1.0)
+            self.longest_run = max(self.longest_run, time - self.run_start)
+        self.in_run = low
+
+    def expire(self, now):
+        self.confidence.expire(now)
+        self.histogram.expire(now)
+        self.run_starts.expire(now)
+
+    def run_rate(self):
+        '''Low-confidence runs per minute in the window.'''
+        return len(self.run_starts) * 60.0 / self.run_starts.window
+
+    def summary(self):
+        summary = {'samples': self.samples, 'histogram': self.session_histogram,
+                   'lowConfidenceRuns': self.runs, 'longestLowConfidenceRun': round(self.longest_run, 3)}
+        if self.samples:
+            summary['meanConfidence'] = round(self.confidence_total / self.samples, 4)
+            summary['lowConfidencePercent'] = round(100.0 * self.low_samples / self.samples, 2)
+        return summary
+
+class Quality_Monitor(object):
+    def __init__(self, window=10.0, low_confidence=0.6, max_marker_error=0.002,
+                 min_valid_percent=90.0, min_confidence=0.6, max_run_rate=10.0):
+        '''
+        window is the length of the rolling window in seconds and
+        low_confidence the pupil confidence below which a sample is part of
+        a low-confidence run. The alarm thresholds are the max mean marker
+        error (m), min valid percentage, min mean confidence and max
+        low-confidence runs per minute, 0 turns an alarm off.
+        '''
+        self.window = window
+        self.low_confidence = low_confidence
+        self.thresholds = {'maxMarkerError': max_marker_error,
+                           'minValidPercent': min_valid_percent,
+                           'minConfidence': min_confidence,
+                           'maxLowConfidenceRunsPerMinute': max_run_rate}
+        self.bodies = {}
+        self.eyes = {}
+        self.alarms = {}
+
+    def add_frame(self, time, frame, present=None):
+        '''
+        Add the rigid bodies and pupil samples of a recorded frame. present is
+        the set of ids of the rigid bodies that were in the frame, the others
+        only repeat older values and are left out. None adds all of them.
+        '''
+        for rb in frame.get('rigidBodies', ()):
+            if present is not None and rb['id'] not in present:
+                continue
+            body = self.bodies.get(rb['id'])
+            if body is None:
+                body = self.bodies[rb['id']] = Body_Quality(self.window)
+            body.add(time, rb)
+        for eye in EYES:
+            sample = frame.get(eye)
+            if sample is not None and 'confidence' in sample:
+                quality = self.eyes.get(eye)
+                if quality is None:
+                    quality = self.eyes[eye] = Eye_Quality(self.window, self.low_confidence)
+                quality.add(time, sample['confidence'])
+
+    def expire(self, now):
+        '''Drop samples older than the window, for sources that stopped sending.'''
+        for quality in list(self.bodies.values()) + list(self.eyes.values()):
+            quality.expire(now)
+
+    def check_alarms(self, now):
+        '''Return the alarms raised by the rolling metrics as (name, source, value) tuples.'''
+        self.expire(now)
+        thresholds = self.thresholds
+        raised = []
+        for id, body in sorted(self.bodies.items()):
+            error = body.marker_error.mean
+            if thresholds['maxMarkerError'] and error is not None and error > thresholds['maxMarkerError']:
+                raised.append(('markerError', str(id), error))
+            valid = body.valid.mean
+            if thresholds['minValidPercent'] and valid is not None and valid * 100.0 < thresholds['minValidPercent']:
+                raised.append(('validPercent', str(id), valid * 100.0))
+        for eye, quality in sorted(self.eyes.items()):
+            confidence = quality.confidence.mean
+            if thresholds['minConfidence'] and confidence is not None and confidence < thresholds['minConfidence']:
+                raised.append(('confidence', eye, confidence))
+            rate = quality.run_rate()
+            if thresholds['maxLowConfidenceRunsPerMinute'] and rate > thresholds['maxLowConfidenceRunsPerMinute']:
+                raised.append(('lowConfidenceRuns', eye, rate))
+
+        # Remember when each alarm was first and last raised
+        for name, source, value in raised:
+            alarm = self.alarms.setdefault((name, source), {'alarm': name, 'source': source, 'first': now, 'count': 0})
+            alarm['last'] = now
+            alarm['count'] += 1
+        return raised
+
+    def status(self, raised=()):
+        '''One line with the worst rolling metrics and the raised alarms, for the console.'''
+        parts = []
+        errors = [body.marker_error.mean for body in self.bodies.values() if body.marker_error.mean is not None]
+        if errors:
+            parts.append('err %.2f mm' % (max(errors) * 1000.0))
+        valid = [body.valid.mean for body in self.bodies.values() if body.valid.mean is not None]
+        if valid:
+            parts.append('valid %.0f%%' % (min(valid) * 100.0))
+        for eye, quality in sorted(self.eyes.items()):
+            if quality.confidence.mean is not None:
+                parts.append('conf%s %.2f' % (eye[-1], quality.confidence.mean))
+        if raised:
+            parts.append('ALARM ' + ', '.join('%s %s' % (name, source) for name, source, value in raised))
+        return ' '.join(parts)
+
+    def summary(self):
+        '''Compact summary of the whole session for the recording header.'''
+        summary = {'window': self.window, 'lowConfidence': self.low_confidence, 'thresholds': self.thresholds,
+                   'rigidBodies': dict((str(id), body.summary()) for id, body in sorted(self.bodies.items()))}
+        for eye, quality in sorted(self.eyes.items()):
+            summary[eye] = quality.summary()
+        summary['alarms'] = [dict(alarm, first=round(alarm['first'], 3), last=round(alarm['last'], 3))
+                             for alarm in self.alarms.values()]
+        return summary
+
+    def summary_size(self, bodies):
+        '''Generous estimate of the length of the summary json for this many rigid bodies.'''
+        return 2048 + 128 * bodies
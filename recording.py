@@ -0,0 +1,127 @@
+'''
+Helpers for reading and writing recordings made by capture.py.
+
+A recording is a json file with the header on its own line followed by one
+frame per line, so it can be read frame by frame without loading the whole
+file into memory.
+
+Values only known once recording ends, like the quality summary, are
+written into space reserved in the header. If they don't fit they are
+added after the last frame instead:
+
+{"frame": 8210, ...}], "quality": {...}}
+
+read_trailer reads them from there.
+'''
+
+import json
+
+_decoder = json.JSONDecoder()
+
+def read_header(f):
+    '''Read the static header from the start of an open recording file.
+    Leaves the file positioned at the first frame.
+    '''
+    line = f.readline()
+    if line.strip() != '{"static":':
+        raise ValueError("not a recording file")
+    header, end = _decoder.raw_decode(f.readline()) # header followed by ','
+    f.readline() # "frames": [
+    return header
+
+def decode_frame(line):
+    '''Decode one frame line of a recording, None for the closing line.'''
+    line = line.strip()
+    if not line or line.startswith(']'):
+        return None
+    # raw_decode ignores the trailing ',' or ']}' of the line
+    frame, end = _decoder.raw_decode(line)
+    return frame
+
+def iter_frames(f):
+    '''Yield the frames of an open recording file positioned at the first frame.'''
+    for line in f:
+        frame = decode_frame(line)
+        if frame is not None:
+            yield frame
+
+def read_trailer(path):
+    '''Return the keys written after the frames of a recording, see Recording_Writer.close.'''
+    with open(path, 'rb') as f:
+        f.seek(0, 2)
+        f.seek(max(0, f.tell() - 65536))
+        last = f.read().decode('utf-8').rstrip().rpartition('\n')[2]
+    if last.startswith('{'):
+        frame, end = _decoder.raw_decode(last)
+        last = last[end:]
+    if not last.startswith('],'):
+        return {}
+    return json.loads('{' + last[2:])
+
+def iter_batches(f, size):
+    '''Yield lists of up to size frames from an open recording file.'''
+    batch = []
+    for frame in iter_frames(f):
+        batch.append(frame)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def open_recording(path):
+    '''Open a recording, returning the file positioned at the first frame and the header.'''
+    f = open(path)
+    try:
+        header = read_header(f)
+    except Exception:
+        f.close()
+        raise
+    return f, header
+
+class Recording_Writer(object):
+    '''
+    Writes a recording: the static header followed by one frame per line.
+    reserve is a (key, size) pair reserving size characters for a header
+    value given when the recording is closed.
+    '''
+    def __init__(self, f, header, reserve=None):
+        self.f = f
+        self.first_frame = True
+        self.reserved = None
+        f.write('{\"static\": \n')
+        if reserve is None:
+            f.write(json.dumps(header))
+        else:
+            # The value starts out as null followed by spaces
+            key, size = reserve
+            text = json.dumps(dict(header, **{key: None}))
+            f.write(text[:-len('null}')])
+            self.reserved = (key, f.tell(), size)
+            f.write('null'.ljust(size) + '}')
+        f.write(',\n\"frames\": [\n')
+
+    def write(self, text):
+        '''Write a frame already serialized to json.'''
+        if not self.first_frame:
+            self.f.write(",\n")
+        else:
+            self.first_frame = False
+        self.f.write(text)
+
+    def close(self, value=None):
+        '''Finish the recording, filling in the reserved header value.'''
+        if self.reserved is None or value is None:
+            self.f.write(']}\n')
+            return
+
+        key, position, size = self.reserved
+        text = json.dumps(value)
+        if len(text) > size:
+            self.f.write('], %s: %s}\n' % (json.dumps(key), text))
+            return
+        self.f.write(']}\n')
+        end = self.f.tell()
+        self.f.seek(position)
+        self.f.write(text.ljust(size))
+        self.f.seek(end)
@@ -0,0 +1,370 @@
+'''
+Records several Pupil Labs eye trackers and OptiTrack systems in one session.
+
+The sources are listed in a session config file:
+
+{
+    "output": "session.json",
+    "framesPerSecond": 120,
+    "sources": [
+        {"name": "eyes1", "type": "pupil", "ip": "192.168.1.10", "port": 50020,
+         "topics": ["pupil.0", "pupil.1"], "core": 1},
+        {"name": "eyes2", "type": "pupil", "ip": "192.168.1.11", "port": 50020},
+        {"name": "motive", "type": "optitrack", "ip": "192.168.1.20",
+         "multicastAddress": "239.255.42.99", "commandPort": 1510, "dataPort": 1511,
+         "modelCache": "motive_modeldef.json"}
+    ]
+}
+
+Several OptiTrack sources on the same dataPort receive each other's
+multicast packets (on Linux even when their multicastAddresses differ), so
+each of them only keeps the data packets sent from its "dataSourceAddress",
+its "ip" by default. That has to be the address of the interface Motive
+streams from, which is not 127.0.0.1 even when Motive runs on the
+recording machine. Sources that would need the same dataSourceAddress are
+refused, give them different dataPorts in Motive instead.
+
+Every source runs in its own worker process, pinned to its own core ("core",
+or the next free one when not given), and sends what it receives to the
+main process through its own queue, so a busy source can't hold up the
+others. The main process merges the samples of every source into one frame
+framesPerSecond times a second. Each frame has an entry per source holding,
+for each of its streams, the list of every sample received since the
+previous frame, oldest first. No sample is dropped or written twice, and a
+stream without new samples is left out. Each sample is tagged with the
+recvTime it arrived at (seconds since the recording started):
+
+{"frame": 1, "time": 0.008,
+ "eyes1": {"pupil0": [{..., "recvTime": 0.001}, {..., "recvTime": 0.006}], "pupil1": [...]},
+ "motive": {"mocap": [{"recvTime": 0.006, "frameNumber": 1520, "timestamp": 12.6,
+                       "rigidBodies": [...], "markers": [...]}]}}
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sys
+from queue import Empty
+from time import sleep, time
+
+from recording import Recording_Writer
+
+DEFAULT_PUPIL_TOPICS = ('pupil.0', 'pupil.1')
+
+def pin_to_core(core):
+    '''Pin the calling process to one core. Returns False if that isn't possible here.'''
+    try:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, {core})
+        else:
+            import psutil
+            psutil.Process().cpu_affinity([core])
+    except (ImportError, OSError, ValueError):
+        return False
+    return True
+
+def stream_name(topic):
+    '''pupil.0 -> pupil0, the key capture.py uses for the topic.'''
+    return topic.replace('.', '')
+
+def pupil_worker(source, queue, stop, timeout):
+    '''Worker process receiving pupil data from one Pupil Remote.'''
+    import zmq
+    from capture import Msg_Receiver, request_sub_port
+
+    start = time()
+    deadline = start + timeout
+    try:
+        ctx = zmq.Context()
+        remote_url = 'tcp://%s:%d' % (source['ip'], source.get('port', 50020))
+        sub_url = 'tcp://%s:%s' % (source['ip'], request_sub_port(ctx, remote_url, timeout))
+
+        poller = zmq.Poller()
+        receivers = {}
+        topics = {}
+        for topic in source.get('topics', DEFAULT_PUPIL_TOPICS):
+            receiver = Msg_Receiver(ctx, sub_url, topics=(topic,), timeout=max(0, deadline - time()))
+            poller.register(receiver.socket, zmq.POLLIN)
+            receivers[receiver.socket] = receiver
+            topics[receiver.socket] = topic
+
+        # Ready once every topic has data waiting
+        waiting = set(receivers)
+        while waiting:
+            remaining = deadline - time()
+            if remaining <= 0:
+                raise TimeoutError("no data on %s within %.1fs" % (
+                    ', '.join(sorted(topics[sock] for sock in waiting)), timeout))
+            waiting.difference_update(sock for sock, event in poller.poll(remaining * 1000))
+        queue.put(('ready', time() - start, {}))
+
+        while not stop.is_set():
+            for sock, event in poller.poll(100):
+                topic, payload = receivers[sock].recv()
+                queue.put(('sample', stream_name(topic), time(), payload))
+    except Exception as e:
+        queue.put(('error', time() - start, str(e)))
+
+def optitrack_worker(source, queue, stop, timeout):
+    '''Worker process receiving frames from one NatNet server.'''
+    from NatNetClient import NatNetClient
+
+    start = time()
+    deadline = start + timeout
+    try:
+        client = NatNetClient(source['ip'],
+                              source.get('multicastAddress', '239.255.42.99'),
+                              source.get('commandPort', 1510),
+                              source.get('dataPort', 1511))
+        client.modelDefCachePath = source.get('modelCache')
+        client.dataSourceAddress = source.get('dataSourceAddress')
+        cached = client.loadModelDefCache()
+
+        def on_model_def(version, descriptions):
+            queue.put(('static', time(), {'modelDefVersion': version, 'rigidBodyInfo': descriptions}))
+
+        def on_frame(frameNumber, markerSetCount, unlabeledMarkersCount, rigidBodyCount, skeletonCount,
+                     labeledMarkerCount, latency, timecode, timecodeSub, timestamp, isRecording, trackedModelsChanged):
+            # Called on the client's data thread with the client locked
+            queue.put(('sample', 'mocap', time(), {
+                'frameNumber': frameNumber,
+                'timestamp': timestamp,
+                'rigidBodies': [dict(rb) for rb in client.getRigidBodyList()],
+                'markers': client.getMarkerList() }))
+
+        client.modelDefListener = on_model_def
+        client.run()
+
+        if not cached and not client.waitForModelDef(max(0, deadline - time())):
+            raise TimeoutError("no model definition within %.1fs" % timeout)
+        if not client.waitForFrame(max(0, deadline - time())):
+            raise TimeoutError("no frame of data within %.1fs" % timeout)
+
+        client.lock()
+        static = {'modelDefVersion': client.modelDefVersion,
+                  'rigidBodyInfo': client.getRigidBodyDescription()}
+        client.newFrameListener = on_frame
+        client.unlock()
+        queue.put(('ready', time() - start, static))
+
+        stop.wait()
+    except Exception as e:
+        queue.put(('error', time() - start, str(e)))
+
+WORKERS = {
+    'pupil': pupil_worker,
+    'optitrack': optitrack_worker }
+
+def source_worker(source, queue, stop, timeout):
+    # Ctrl-C is handled by the main process, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if 'core' in source and not pin_to_core(source['core']):
+        print( 'Could not pin %s to core %d' % (source['name'], source['core']) )
+    WORKERS[source['type']](source, queue, stop, timeout)
+
+class Source(object):
+    '''Main process side of a source: its worker, queue, samples since the last frame and health.'''
+    def __init__(self, config, stop, timeout):
+        self.name = config['name']
+        self.config = config
+        self.queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=source_worker, args=(config, self.queue, stop, timeout), daemon=True)
+        self.pending = {}
+        self.statics = []
+        self.samples = 0
+        self.last_sample = None
+        self.ready = None
+        self.error = None
+        self.header = {}
+
+    def start(self):
+        self.process.start()
+
+    def wait_ready(self, timeout):
+        deadline = time() + timeout
+        while True:
+            try:
+                kind, elapsed, info = self.queue.get(timeout=max(0, deadline - time()))
+            except Empty:
+                self.error = 'worker did not report within %.1fs' % timeout
+                return
+            if kind == 'ready':
+                # Model definition changes before this are part of the ready info
+                self.ready = elapsed
+                self.header = info
+                return
+            if kind == 'error':
+                self.error = info
+                return
+
+    def drain(self, start_time, limit=1000):
+        '''Take up to limit messages from the worker without blocking.'''
+        for i in range(limit):
+            try:
+                message = self.queue.get_nowait()
+            except Empty:
+                return
+            kind = message[0]
+            if kind == 'sample':
+                kind, stream, received, payload = message
+                payload['recvTime'] = received - start_time
+                self.pending.setdefault(stream, []).append(payload)
+                self.samples += 1
+                self.last_sample = received
+            elif kind == 'static':
+                self.statics.append(message[2])
+            elif kind == 'error':
+                self.error = message[2]
+
+    def take(self):
+        '''Return the samples of every stream received since the last call.'''
+        pending = self.pending
+        self.pending = {}
+        return pending
+
+def run_session(config, check=False, startup_timeout=5.0):
+    if check:
+        # Measure how long the servers take to answer, not how long reading the cache takes
+        for source in config['sources']:
+            source.pop('modelCache', None)
+
+    stop = multiprocessing.Event()
+    sources = [Source(source, stop, startup_timeout) for source in config['sources']]
+
+    names = [source.name for source in sources]
+    if len(set(names)) != len(names):
+        raise ValueError("source names must be unique")
+
+    # OptiTrack sources on the same data port receive each other's multicast packets
+    # (on Linux even with different groups), so each only keeps those from its own server
+    by_port = {}
+    for source in sources:
+        if source.config['type'] == 'optitrack':
+            by_port.setdefault(source.config.get('dataPort', 1511), []).append(source.config)
+    for port, shared in by_port.items():
+        if len(shared) > 1:
+            addresses = [source.setdefault('dataSourceAddress', source['ip']) for source in shared]
+            if len(set(addresses)) != len(addresses):
+                raise ValueError("OptiTrack sources %s share data port %d and stream from the same address, "
+                                 "give them different dataPorts" % (', '.join(source['name'] for source in shared), port))
+
+    # Give each source without a core its own one, leaving core 0 for this process
+    cores = os.cpu_count() or 1
+    used = set(source.config['core'] for source in sources if 'core' in source.config)
+    free = [core for core in range(1, cores) if core not in used]
+    for source in sources:
+        if 'core' not in source.config and free:
+            source.config['core'] = free.pop(0)
+
+    for source in sources:
+        print( 'Starting %s (%s) on core %s' % (source.name, source.config['type'], source.config.get('core', 'any')) )
+        source.start()
+
+    # The workers start concurrently, so waiting for them one after another
+    # takes as long as the slowest one
+    deadline = time() + startup_timeout + 5.0
+    for source in sources:
+        source.wait_ready(max(0, deadline - time()))
+
+    failed = False
+    for source in sources:
+        if source.error is not None:
+            print( '%s failed to start: %s' % (source.name, source.error) )
+            failed = True
+        elif check:
+            print( '%-20s ready after %.3fs' % (source.name, source.ready) )
+
+    if check or failed:
+        stop.set()
+        return 1 if failed else 0
+
+    header = {'sources': config['sources']}
+    for source in sources:
+        if source.header:
+            header[source.name] = source.header
+
+    input( 'Press Enter to continue and start recording...' )
+    print( "Recording Started" )
+    print( 'Press Ctrl-C to stop recording' )
+
+    interval = 1.0 / config.get('framesPerSecond', 70)
+    start_time = time()
+    with open(config.get('output', 'session.json'), 'w') as f:
+        writer = Recording_Writer(f, header)
+        try:
+            frame = 1
+            report_time = time()
+            report_samples = [0] * len(sources)
+            while True:
+                sft = time()
+                obj = {}
+                obj['frame'] = frame
+                obj['time'] = sft - start_time
+                for source in sources:
+                    source.drain(start_time)
+                    if source.statics:
+                        obj.setdefault('static', {})[source.name] = source.statics[-1]
+                        source.statics = []
+                    obj[source.name] = source.take()
+                writer.write(json.dumps(obj))
+                frame = frame + 1
+
+                # Report per source throughput and health once a second
+                if sft - report_time >= 1.0:
+                    status = []
+                    for i, source in enumerate(sources):
+                        rate = (source.samples - report_samples[i]) / (sft - report_time)
+                        report_samples[i] = source.samples
+                        if source.error is not None:
+                            state = 'FAILED'
+                        elif source.last_sample is None or sft - source.last_sample > 1.0:
+                            state = 'STALLED'
+                        else:
+                            state = 'ok'
+                        status.append('%s: %.0f/s %s' % (source.name, rate, state))
+                    sys.stdout.write("\rframe: %d  %s" % (frame, '  '.join(status)))
+                    sys.stdout.flush()
+                    report_time = sft
+
+                sleep(max(0, interval - (time() - sft)))
+        except KeyboardInterrupt:
+            writer.close()
+            print( "" )
+
+    stop.set()
+    for source in sources:
+        source.process.join(1.0)
+        print( '%s: %d samples%s' % (source.name, source.samples,
+                                     '' if source.error is None else ', failed: ' + source.error) )
+    print( "Done" )
+    return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='python session.py',
+        description='''
+            Records several Pupil Labs and OptiTrack sources into one
+            time-indexed json file. The sources are listed in a session
+            config file, see the top of session.py.''')
+    parser.add_argument("config",
+                        help="path to the session config file.")
+    parser.add_argument("--output",
+                        help="path to output file, overrides the config.")
+    parser.add_argument("--startup-timeout",
+                        default=5.0,
+                        type=float,
+                        help="seconds to wait for every source to become ready. (default: 5.0)")
+    parser.add_argument('--check',
+                        action='store_true',
+                        help="report how long each source takes to become ready and exit.")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+    if args.output:
+        config['output'] = args.output
+
+    sys.exit(run_session(config, args.check, args.startup_timeout))
@@ -0,0 +1,571 @@
+'''
+Long-session soak test for NatNetClient and the capture loop.
+
+Runs a synthetic NatNet server (and a synthetic Pupil Remote when zmq is
+installed) on localhost and records from them with capture.py's own
+startup and Capture_Loop, for a configurable duration. Arguments soak.py
+doesn't know are passed on to capture.py, so any of its features can be
+soaked, e.g. --codec --float-format %.6f. At every interval it samples
+the process RSS, the memory traced by tracemalloc, the number of allocated
+blocks and the garbage collector's pause times. At the end it writes a json
+report with the samples, the growth rates after the warmup period, the top
+allocators and whether any threshold was exceeded:
+
+python soak.py --duration 3600 --report soak_report.json --pose-filter kalman
+
+Reports from different releases can be compared with --compare.
+The exit code is 1 if a threshold was exceeded.
+'''
+
+import argparse
+import gc
+import json
+import math
+import os
+import platform
+import socket
+import struct
+import sys
+import tracemalloc
+from threading import Thread, Event
+from time import sleep, time, perf_counter
+
+from NatNetClient import NatNetClient
+
+def _cstring(text):
+    return text.encode('utf-8') + b'\0'
+
+def pack_model_def(bodies):
+    '''NAT_MODELDEF packet describing rigid bodies given as (id, name) pairs.'''
+    data = struct.pack('<i', len(bodies))
+    for id, name in bodies:
+        data += struct.pack('<i', 1) + _cstring(name)
+        data += struct.pack('<iI', id, 0xFFFFFFFF) + struct.pack('<fff', 0.0, 0.0, 0.0)
+    return struct.pack('<HH', NatNetClient.NAT_MODELDEF, len(data) + 4) + data
+
+def pack_ping_response(appName='Soak'):
+    '''NAT_PINGRESPONSE packet of a NatNet 3.0 server.'''
+    data = appName.encode('utf-8').ljust(256, b'\0') + bytes((1, 0, 0, 0)) + bytes((3, 0, 0, 0))
+    return struct.pack('<HH', NatNetClient.NAT_PINGRESPONSE, len(data) + 4) + data
+
+def pack_rigid_body(id, position, rotation, markers, valid=True, error=0.0005):
+    data = struct.pack('<i', id) + struct.pack('<fff', *position) + struct.pack('<ffff', *rotation)
+    data += struct.pack('<i', len(markers))
+    for marker in markers:
+        data += struct.pack('<fff', *marker)
+    for i in range(len(markers)):
+        data += struct.pack('<i', i + 1)
+    data += struct.pack('<f', 0.014) * len(markers)
+    data += struct.pack('<f', error) + struct.pack('<h', 1 if valid else 0)
+    return data
+
+def pack_frame(frameNumber, rigidBodies, unlabeledMarkers, labeledMarkers, timestamp, trackedModelsChanged=False,
+               skeletons=()):
+    '''
+    NAT_FRAMEOFDATA packet in the NatNet 3.0 layout NatNetClient parses. skeletons
+    are (id, rigidBodies) pairs with the rigid bodies given like rigidBodies.
+    '''
+    data = struct.pack('<i', frameNumber)
+    # One marker set named 'all' holding the same markers as the unlabeled list
+    data += struct.pack('<i', 1) + _cstring('all') + struct.pack('<i', len(unlabeledMarkers))
+    for marker in unlabeledMarkers:
+        data += struct.pack('<fff', *marker)
+    data += struct.pack('<i', len(unlabeledMarkers))
+    for marker in unlabeledMarkers:
+        data += struct.pack('<fff', *marker)
+    data += struct.pack('<i', len(rigidBodies))
+    for rigidBody in rigidBodies:
+        data += pack_rigid_body(*rigidBody)
+    data += struct.pack('<i', len(skeletons))
+    for id, skeletonRigidBodies in skeletons:
+        data += struct.pack('<ii', id, len(skeletonRigidBodies))
+        for rigidBody in skeletonRigidBodies:
+            data += pack_rigid_body(*rigidBody)
+    data += struct.pack('<i', len(labeledMarkers))
+    for i, marker in enumerate(labeledMarkers):
+        data += struct.pack('<i', i + 1) + struct.pack('<fff', *marker) + struct.pack('<f', 0.014) + struct.pack('<h', 0)
+    data += struct.pack('<i', 0) # force plates
+    data += struct.pack('<f', 0.004) + struct.pack('<ii', 0, 0) + struct.pack('<d', timestamp)
+    data += struct.pack('<h', 0x02 if trackedModelsChanged else 0)
+    return struct.pack('<HH', NatNetClient.NAT_FRAMEOFDATA, len(data) + 4) + data
+
+class Synthetic_NatNet_Server(object):
+    '''
+    Streams frames of moving rigid bodies to localhost and answers model
+    definition requests and pings. Every model_change_interval seconds a rigid body is
+    added or removed and the frame flags the tracked models as changed.
+    '''
+    def __init__(self, command_port, data_port, rigid_bodies=10, markers=5, unlabeled_markers=20,
+                 rate=240, model_change_interval=60.0):
+        self.command_port = command_port
+        self.data_port = data_port
+        self.rigid_bodies = rigid_bodies
+        self.markers = markers
+        self.unlabeled_markers = unlabeled_markers
+        self.rate = rate
+        self.model_change_interval = model_change_interval
+        self.body_count = rigid_bodies
+        self._stop = Event()
+
+    def _bodies(self):
+        return [(i + 1, 'RigidBody %d' % (i + 1)) for i in range(self.body_count)]
+
+    def _command_thread(self, sock):
+        sock.settimeout(0.2)
+        while not self._stop.is_set():
+            try:
+                data, address = sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            messageID = int.from_bytes(data[0:2], byteorder='little')
+            if messageID == NatNetClient.NAT_REQUEST_MODELDEF:
+                sock.sendto(pack_model_def(self._bodies()), address)
+            elif messageID == NatNetClient.NAT_PING:
+                sock.sendto(pack_ping_response(), address)
+        sock.close()
+
+    def _data_thread(self, sock):
+        frameNumber = 0
+        start = perf_counter()
+        last_change = start
+        while not self._stop.is_set():
+            now = perf_counter()
+            t = now - start
+            changed = False
+            if self.model_change_interval and now - last_change >= self.model_change_interval:
+                # Alternate between one extra body and the configured count
+                self.body_count = self.rigid_bodies + 1 if self.body_count == self.rigid_bodies else self.rigid_bodies
+                last_change = now
+                changed = True
+            rigidBodies = []
+            for i in range(self.body_count):
+                x = i * 0.2 + 0.05 * math.sin(t + i)
+                half = 0.1 * math.sin(0.5 * t + i)
+                markers = [(x + 0.01 * j, 1.5, 0.01 * j) for j in range(self.markers)]
+                rigidBodies.append((i + 1, (x, 1.5, 0.0), (0.0, math.sin(half), 0.0, math.cos(half)),
+                                    markers, frameNumber % 97 != i))
+            unlabeled = [(0.1 * j, 0.0, 0.0) for j in range(self.unlabeled_markers)]
+            sock.sendto(pack_frame(frameNumber, rigidBodies, unlabeled, unlabeled[:5], t, changed),
+                        ('127.0.0.1', self.data_port))
+            frameNumber += 1
+            sleep(max(0, frameNumber / self.rate - (perf_counter() - start)))
+        sock.close()
+
+    def start(self):
+        command = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        command.bind(('127.0.0.1', self.command_port))
+        data = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        Thread(target=self._command_thread, args=(command,), daemon=True).start()
+        Thread(target=self._data_thread, args=(data,), daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+class Synthetic_Pupil_Remote(object):
+    '''Answers SUB_PORT and publishes pupil.0 / pupil.1 data at rate Hz.'''
+    def __init__(self, port, pub_port, rate=200):
+        self.port = port
+        self.pub_port = pub_port
+        self.rate = rate
+        self._stop = Event()
+
+    def _remote_thread(self, ctx):
+        import zmq
+        remote = ctx.socket(zmq.REP)
+        remote.bind('tcp://127.0.0.1:%d' % self.port)
+        while not self._stop.is_set():
+            if remote.poll(200):
+                request = remote.recv_string()
+                remote.send_string(str(self.pub_port) if request == 'SUB_PORT' else 'Unknown command.')
+        remote.close(0)
+
+    def _publish_thread(self, ctx):
+        import zmq
+        import msgpack as serializer
+        publisher = ctx.socket(zmq.PUB)
+        publisher.bind('tcp://127.0.0.1:%d' % self.pub_port)
+        count = 0
+        start = perf_counter()
+        while not self._stop.is_set():
+            t = perf_counter() - start
+            for eye in (0, 1):
+                pupil = {'topic': 'pupil', 'id': eye, 'timestamp': t, 'method': '2d c++',
+                         'norm_pos': [0.5 + 0.1 * math.sin(t), 0.5 + 0.1 * math.cos(t)],
+                         'confidence': 0.9, 'diameter': 30.0,
+                         'ellipse': {'center': [96.0, 96.0], 'axes': [30.0, 28.0], 'angle': 10.0}}
+                publisher.send_string('pupil.%d' % eye, zmq.SNDMORE)
+                publisher.send(serializer.dumps(pupil, use_bin_type=True))
+            count += 1
+            sleep(max(0, count / self.rate - (perf_counter() - start)))
+        publisher.close(0)
+
+    def start(self):
+        import zmq
+        ctx = zmq.Context.instance()
+        Thread(target=self._remote_thread, args=(ctx,), daemon=True).start()
+        Thread(target=self._publish_thread, args=(ctx,), daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+def current_rss():
+    '''Resident set size of this process in bytes, None if it can't be read.'''
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def slope_per_hour(times, values):
+    '''Least squares growth of values per hour.'''
+    points = [(t, v) for t, v in zip(times, values) if v is not None]
+    if len(points) < 2:
+        return None
+    mean_t = sum(t for t, v in points) / len(points)
+    mean_v = sum(v for t, v in points) / len(points)
+    variance = sum((t - mean_t) ** 2 for t, v in points)
+    if variance == 0:
+        return None
+    return 3600.0 * sum((t - mean_t) * (v - mean_v) for t, v in points) / variance
+
+def _empty_sample():
+    return {'time': 0.0, 'frames': 0, 'rss': None, 'traced': 0, 'tracedPeak': 0, 'blocks': 0,
+            'gcCollections': [0, 0, 0]}
+
+class Soak_Monitor(object):
+    '''
+    Samples memory use and garbage collector pauses of this process.
+    capacity is the number of samples expected, they are allocated up front
+    so that storing them doesn't add to the growth they measure.
+    '''
+    def __init__(self, capacity, trace_frames=1, top=10):
+        self.top = top
+        self.samples = [_empty_sample() for i in range(capacity)]
+        self.count = 0
+        self.gc_pauses = {0: [], 1: [], 2: []}
+        self._gc_start = None
+        tracemalloc.start(trace_frames)
+        gc.callbacks.append(self._gc_callback)
+        self.start = time()
+        self.baseline = None
+        self.baseline_index = 0
+
+    def _gc_callback(self, phase, info):
+        if phase == 'start':
+            self._gc_start = perf_counter()
+        elif self._gc_start is not None:
+            self.gc_pauses[info['generation']].append(perf_counter() - self._gc_start)
+            self._gc_start = None
+
+    def sample(self, frames):
+        if self.count == len(self.samples):
+            self.samples.append(_empty_sample())
+        sample = self.samples[self.count]
+        self.count += 1
+        sample['traced'], sample['tracedPeak'] = tracemalloc.get_traced_memory()
+        sample['time'] = time() - self.start
+        sample['frames'] = frames
+        sample['rss'] = current_rss()
+        sample['blocks'] = sys.getallocatedblocks()
+        for generation, stats in enumerate(gc.get_stats()):
+            sample['gcCollections'][generation] = stats['collections']
+
+    @property
+    def last(self):
+        return self.samples[self.count - 1]
+
+    def mark_baseline(self):
+        '''
+        Snapshot allocations once warmed up, top allocators are reported
+        relative to it. Growth rates only use the samples taken after it since
+        the snapshot itself adds allocated blocks.
+        '''
+        self.baseline = tracemalloc.take_snapshot()
+        self.baseline_index = self.count
+
+    def stop(self):
+        gc.callbacks.remove(self._gc_callback)
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        if self.baseline is not None:
+            stats = snapshot.compare_to(self.baseline, 'lineno')
+        else:
+            stats = snapshot.statistics('lineno')
+        self.top_allocators = []
+        for stat in stats[:self.top]:
+            self.top_allocators.append({
+                'location': '%s:%d' % (stat.traceback[0].filename, stat.traceback[0].lineno),
+                'size': stat.size,
+                'sizeDiff': getattr(stat, 'size_diff', stat.size),
+                'count': stat.count,
+                'countDiff': getattr(stat, 'count_diff', stat.count) })
+
+    def report(self):
+        samples = self.samples[:self.count]
+        # Growth before the warmup is over is the loop filling its buffers, not a leak
+        steady = samples[self.baseline_index:] if self.baseline is not None else []
+        times = [s['time'] for s in steady]
+        duration = times[-1] - times[0] if len(times) > 1 else 0
+        gc_report = {}
+        for generation, pauses in self.gc_pauses.items():
+            gc_report[generation] = {
+                'count': len(pauses),
+                'meanMs': 1000.0 * sum(pauses) / len(pauses) if pauses else 0.0,
+                'maxMs': 1000.0 * max(pauses) if pauses else 0.0,
+                'totalMs': 1000.0 * sum(pauses) }
+        collections = None
+        if duration > 0:
+            collections = (steady[-1]['gcCollections'][0] - steady[0]['gcCollections'][0]) / duration
+        return {
+            'rssGrowthMBPerHour': _mb(slope_per_hour(times, [s['rss'] for s in steady])),
+            'tracedGrowthMBPerHour': _mb(slope_per_hour(times, [s['traced'] for s in steady])),
+            'blocksGrowthPerHour': slope_per_hour(times, [s['blocks'] for s in steady]),
+            'gen0CollectionsPerSecond': collections,
+            'gcPauses': gc_report,
+            'topAllocators': self.top_allocators,
+            'samples': samples }
+
+def _mb(value):
+    return None if value is None else value / (1024.0 * 1024.0)
+
+def run_soak(args, capture_arguments=()):
+    import capture
+
+    server = Synthetic_NatNet_Server(args.command_port, args.data_port, args.rigid_bodies, args.markers,
+                                     args.unlabeled_markers, args.optitrack_rate, args.model_change_interval)
+    server.start()
+    if not args.pupil_labs_off:
+        remote = Synthetic_Pupil_Remote(args.pupil_port, args.pupil_port + 1, args.pupil_rate)
+        remote.start()
+
+    # capture.py's arguments for the synthetic sources, the ones given on the command line come last and win
+    parser = capture.build_parser()
+    arguments = ['--output', args.output,
+                 '--max-frames-per-second', str(args.fps),
+                 '--optitrack-ip', '127.0.0.1',
+                 '--optitrack-command-port', str(args.command_port),
+                 '--optitrack-data-port', str(args.data_port),
+                 '--optitrack-multicast-address', args.multicast_address,
+                 '--optitrack-model-cache', '',
+                 '--pupil-labs-ip', '127.0.0.1',
+                 '--pupil-labs-port', str(args.pupil_port)]
+    if args.output == os.devnull:
+        arguments += ['--events-output', os.devnull]
+    if args.pupil_labs_off:
+        arguments.append('--pupil-labs-off')
+    capture_args = parser.parse_args(arguments + list(capture_arguments))
+    capture.check_args(parser, capture_args)
+
+    ready = {}
+    receivers = None
+    try:
+        if not capture_args.pupil_labs_off:
+            import zmq
+            receivers = capture.connect_pupil_labs(zmq.Context.instance(), capture_args, 5.0, ready)
+        client = capture.connect_optitrack(capture_args, 5.0, ready)
+    except TimeoutError as e:
+        print( 'Synthetic sources did not respond: %s' % e )
+        return None
+    loop = capture.Capture_Loop(capture_args, receivers, client)
+
+    monitor = Soak_Monitor(int(args.duration / args.interval) + 3, args.trace_frames)
+    monitor.sample(0)
+
+    print( 'Soaking for %.0fs, sampling every %.0fs' % (args.duration, args.interval) )
+    start_time = time()
+    next_sample = start_time + args.interval
+
+    def on_frame(frame):
+        nonlocal next_sample
+        now = time()
+        if now >= next_sample:
+            monitor.sample(frame)
+            next_sample += args.interval
+            if monitor.baseline is None and now - start_time >= args.warmup:
+                monitor.mark_baseline()
+
+    def status():
+        last = monitor.last
+        return "rss: %s MB traced: %.1f MB" % ('?' if last['rss'] is None else '%.1f' % _mb(last['rss']),
+                                              _mb(last['traced']))
+
+    frames = loop.run(args.duration, on_frame, status, keyboard=False)
+    print( "" )
+
+    monitor.sample(frames)
+    monitor.stop()
+    client.stopPing()
+    server.stop()
+
+    report = monitor.report()
+    report['frames'] = frames
+    # A loop that can't keep up with the pupil rate lets messages queue up in
+    # zmq, which shows up as RSS growth outside the Python heap
+    report['achievedFps'] = frames / max(1e-9, time() - start_time)
+    report['natNetFrameRate'] = args.optitrack_rate
+    report['environment'] = {
+        'python': sys.version,
+        'platform': platform.platform() }
+    report['settings'] = {
+        'duration': args.duration,
+        'interval': args.interval,
+        'warmup': args.warmup,
+        'fps': args.fps,
+        'rigidBodies': args.rigid_bodies,
+        'markers': args.markers,
+        'unlabeledMarkers': args.unlabeled_markers,
+        'pupilLabs': not args.pupil_labs_off,
+        'capture': list(capture_arguments) }
+
+    failures = []
+    limits = (('rssGrowthMBPerHour', args.max_rss_growth),
+              ('tracedGrowthMBPerHour', args.max_traced_growth),
+              ('blocksGrowthPerHour', args.max_blocks_growth))
+    for key, limit in limits:
+        if limit is not None and report[key] is not None and report[key] > limit:
+            failures.append('%s %.2f > %.2f' % (key, report[key], limit))
+    max_pause = max(g['maxMs'] for g in report['gcPauses'].values())
+    if args.max_gc_pause is not None and max_pause > args.max_gc_pause:
+        failures.append('gc pause %.2fms > %.2fms' % (max_pause, args.max_gc_pause))
+    report['failures'] = failures
+    report['passed'] = not failures
+    return report
+
+def print_summary(report, previous=None):
+    keys = ('achievedFps', 'rssGrowthMBPerHour', 'tracedGrowthMBPerHour', 'blocksGrowthPerHour', 'gen0CollectionsPerSecond')
+    for key in keys:
+        line = '%-26s %s' % (key, _format(report[key]))
+        if previous is not None:
+            line += '   (previous %s)' % _format(previous.get(key))
+        print( line )
+    for generation, pauses in sorted(report['gcPauses'].items()):
+        print( 'gc gen %s pauses             %d, mean %.3fms, max %.3fms' % (
+            generation, pauses['count'], pauses['meanMs'], pauses['maxMs']) )
+    print( 'top allocators since %s:' % ('start' if report['rssGrowthMBPerHour'] is None else 'warmup') )
+    for allocator in report['topAllocators']:
+        print( '  %+10d B %+8d blocks  %s' % (allocator['sizeDiff'], allocator['countDiff'], allocator['location']) )
+    if report['rssGrowthMBPerHour'] is None:
+        print( 'growth rates need at least two samples after the warmup, run longer than --warmup + 2 * --interval' )
+    for failure in report['failures']:
+        print( 'FAILED:', failure )
+    print( 'PASSED' if report['passed'] else 'FAILED' )
+
+def _format(value):
+    return 'n/a' if value is None else '%.3f' % value
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='python soak.py',
+        description='''
+            Runs NatNetClient and the capture loop against synthetic
+            local sources for a long time and reports memory growth,
+            allocations and garbage collector pauses. Other arguments
+            are passed on to capture.py.''')
+    parser.add_argument("--duration",
+                        default=600.0,
+                        type=float,
+                        help="seconds to run. (default: 600)")
+    parser.add_argument("--interval",
+                        default=10.0,
+                        type=float,
+                        help="seconds between samples. (default: 10)")
+    parser.add_argument("--warmup",
+                        default=60.0,
+                        type=float,
+                        help="seconds ignored when computing growth rates. (default: 60)")
+    parser.add_argument("--report",
+                        default="soak_report.json",
+                        help="path to the report. (default: soak_report.json)")
+    parser.add_argument("--compare",
+                        help="path to a previous report to compare with.")
+    parser.add_argument("--output",
+                        default=os.devnull,
+                        help="path the recorded frames are written to. (default: discarded)")
+    parser.add_argument("--fps",
+                        default=120,
+                        type=int,
+                        help="frames recorded per second. (default: 120)")
+    parser.add_argument("--rigid-bodies",
+                        default=10,
+                        type=int,
+                        help="number of synthetic rigid bodies. (default: 10)")
+    parser.add_argument("--markers",
+                        default=5,
+                        type=int,
+                        help="markers per synthetic rigid body. (default: 5)")
+    parser.add_argument("--unlabeled-markers",
+                        default=20,
+                        type=int,
+                        help="number of synthetic unlabeled markers. (default: 20)")
+    parser.add_argument("--optitrack-rate",
+                        default=240,
+                        type=int,
+                        help="synthetic NatNet frames per second. (default: 240)")
+    parser.add_argument("--pupil-rate",
+                        default=200,
+                        type=int,
+                        help="synthetic pupil samples per second and eye. (default: 200)")
+    parser.add_argument("--model-change-interval",
+                        default=60.0,
+                        type=float,
+                        help="seconds between synthetic rigid body changes, 0 to disable. (default: 60)")
+    parser.add_argument("--command-port",
+                        default=21510,
+                        type=int,
+                        help="synthetic NatNet command port. (default: 21510)")
+    parser.add_argument("--data-port",
+                        default=21511,
+                        type=int,
+                        help="synthetic NatNet data port. (default: 21511)")
+    parser.add_argument("--multicast-address",
+                        default="239.255.42.99",
+                        help="multicast address the client joins. (default: 239.255.42.99)")
+    parser.add_argument("--pupil-port",
+                        default=21520,
+                        type=int,
+                        help="synthetic Pupil Remote port, the next port publishes data. (default: 21520)")
+    parser.add_argument('--pupil-labs-off',
+                        action='store_true',
+                        help="don't run the synthetic Pupil Remote (no zmq needed).")
+    parser.add_argument("--trace-frames",
+                        default=1,
+                        type=int,
+                        help="stack frames tracemalloc keeps per allocation. (default: 1)")
+    parser.add_argument("--max-rss-growth",
+                        default=10.0,
+                        type=float,
+                        help="fail if RSS grows by more MB per hour. (default: 10)")
+    parser.add_argument("--max-traced-growth",
+                        default=5.0,
+                        type=float,
+                        help="fail if traced Python memory grows by more MB per hour. (default: 5)")
+    parser.add_argument("--max-blocks-growth",
+                        default=50000.0,
+                        type=float,
+                        help="fail if allocated blocks grow by more per hour. (default: 50000)")
+    parser.add_argument("--max-gc-pause",
+                        default=50.0,
+                        type=float,
+                        help="fail if a garbage collection takes longer in ms. (default: 50)")
+    args, capture_arguments = parser.parse_known_args()
+
+    report = run_soak(args, capture_arguments)
+    if report is None:
+        sys.exit(1)
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_summary(report, previous)
+    print( 'Report saved to', args.report )
+
+    sys.exit(0 if report['passed'] else 1)
@@ -0,0 +1,67 @@
+import json
+import random
+
+from codec import codec_params, Mocap_Encoder, Mocap_Decoder
+
+# Round trip of frames through the codec: encode, write as json, read back and decode.
+# Every value has to come back to within half a resolution step.
+
+PARAMS = codec_params()
+
+def make_frame(n, bodies=3, markers_per_body=3):
+    def vector(n):
+        return [random.uniform(-2.0, 2.0) for i in range(n)]
+
+    frame = {'frame': n, 'time': n / 120.0, 'rigidBodies': []}
+    for i in range(bodies):
+        frame['rigidBodies'].append({
+            'id': i + 1, 'position': vector(3), 'rotation': vector(4), 'markerCount': markers_per_body,
+            'markers': [{'position': vector(3), 'id': j + 1, 'size': [0.014]} for j in range(markers_per_body)],
+            'markerError': random.uniform(0.0, 0.002), 'valid': random.random() > 0.2,
+            # The pose filter adds its fields after the markers
+            'filteredPosition': vector(3), 'filteredRotation': vector(4) })
+    # The unlabeled and labeled markers change from frame to frame
+    frame['markers'] = ([{'labeled': False, 'position': vector(3)} for i in range(random.randint(0, 5))] +
+                        [{'labeled': True, 'id': i, 'position': vector(3), 'size': [0.014]} for i in random.sample(range(10), 3)])
+    return frame
+
+def compare(original, decoded, path='frame'):
+    if isinstance(original, dict):
+        assert sorted(original) == sorted(decoded), "%s: keys %s != %s" % (path, sorted(original), sorted(decoded))
+        for key in original:
+            compare(original[key], decoded[key], '%s.%s' % (path, key))
+    elif isinstance(original, list):
+        assert len(original) == len(decoded), "%s: length %d != %d" % (path, len(original), len(decoded))
+        for i, (a, b) in enumerate(zip(original, decoded)):
+            compare(a, b, '%s[%d]' % (path, i))
+    elif isinstance(original, float):
+        resolution = PARAMS['rotationResolution'] if 'otation' in path else PARAMS['positionResolution']
+        assert abs(original - decoded) <= resolution / 2 * (1 + 1e-9), "%s: %r != %r" % (path, original, decoded)
+    else:
+        assert original == decoded, "%s: %r != %r" % (path, original, decoded)
+
+def round_trip(frames):
+    encoder = Mocap_Encoder(PARAMS)
+    decoder = Mocap_Decoder(PARAMS)
+    for frame in frames:
+        text = json.dumps(encoder.encode(frame))
+        compare(frame, decoder.decode(json.loads(text)))
+    return encoder
+
+def test_round_trip():
+    random.seed(1)
+    encoder = round_trip([make_frame(n + 1) for n in range(250)])
+    # Only the keyframe interval forces keyframes, the changing frame markers don't
+    assert encoder.keyframes == 3, encoder.keyframes
+
+def test_round_trip_layout_changes():
+    random.seed(2)
+    frames = [make_frame(n + 1, bodies=random.randint(0, 3), markers_per_body=random.randint(0, 2)) for n in range(50)]
+    frames[10].pop('markers')
+    frames[20]['static'] = {}
+    round_trip(frames)
+
+if __name__ == '__main__':
+    test_round_trip()
+    test_round_trip_layout_changes()
+    print( "codec round trip ok" )
@@ -0,0 +1,65 @@
+import json
+import os
+import tempfile
+
+from recording import Recording_Writer
+
+try:
+    import pyarrow.parquet as pq
+    from export import export
+except ImportError:
+    pq = None
+
+# Export of small recordings to Parquet, with model definition changes and
+# frames that only mention "static" somewhere else.
+
+HEADER = {'rigidBodyInfo': [{'id': 1, 'name': 'head'}, {'id': 2, 'name': 'hand'}], 'modelDefVersion': 1}
+
+def make_frame(n):
+    return {'frame': n, 'time': n / 120.0,
+            'rigidBodies': [{'id': id, 'position': [0.1 * id, 1.5, n * 0.001], 'rotation': [0.0, 0.0, 0.0, 1.0],
+                             'markerError': 0.0005, 'valid': True} for id in (1, 2)],
+            'markers': [{'labeled': False, 'position': [0.0, 0.0, n * 0.001]}]}
+
+def write_recording(path, frames):
+    with open(path, 'w') as f:
+        writer = Recording_Writer(f, HEADER)
+        for frame in frames:
+            writer.write(json.dumps(frame))
+        writer.close()
+
+def run_export(frames, chunk_size=4):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'recording.json')
+    write_recording(path, frames)
+    rows = export(path, os.path.join(directory, 'out'), chunk_size=chunk_size, workers=1)
+    return rows, pq.read_table(os.path.join(directory, 'out', 'rigid_bodies.parquet')).to_pylist()
+
+def test_static_update():
+    if pq is None:
+        return
+    frames = [make_frame(n + 1) for n in range(12)]
+    # Body 2 is renamed from frame 6 on, which is in the second chunk
+    frames[5]['static'] = {'modelDefVersion': 2,
+                           'rigidBodyInfo': [{'id': 1, 'name': 'head'}, {'id': 2, 'name': 'wand'}]}
+    rows, table = run_export(frames)
+    assert rows['rigid_bodies'] == 24, rows
+    names = dict(((row['frame'], row['id']), row['name']) for row in table)
+    assert names[(5, 2)] == 'hand' and names[(6, 2)] == 'wand' and names[(12, 2)] == 'wand', names
+    assert all(names[(n + 1, 1)] == 'head' for n in range(12))
+
+def test_event_named_static():
+    if pq is None:
+        return
+    frames = [make_frame(n + 1) for n in range(12)]
+    frames[2]['events'] = [{'name': 'static', 'source': 'zmq', 'time': 0.02}]
+    rows, table = run_export(frames)
+    assert rows['rigid_bodies'] == 24, rows
+    assert set(row['name'] for row in table) == {'head', 'hand'}
+
+if __name__ == '__main__':
+    if pq is None:
+        print( "export tests need pyarrow" )
+    test_static_update()
+    test_event_named_static()
+    print( "export ok" )
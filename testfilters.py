@@ -0,0 +1,98 @@
+import math
+
+import numpy as np
+
+from filters import Pose_Filter
+
+# Deterministic runs of the pose filter: constant input, a step and a
+# tracking gap, for both position filters and the rotation smoothing.
+
+RATE = 120.0
+METHODS = ('one-euro', 'kalman')
+
+def z_rotation(degrees):
+    half = math.radians(degrees) / 2.0
+    return [0.0, 0.0, math.sin(half), math.cos(half)]
+
+def angle(a, b):
+    '''Angle in degrees between two quaternions.'''
+    return math.degrees(2.0 * math.acos(min(1.0, abs(float(np.dot(a, b))))))
+
+def run(pose_filter, samples, start=0):
+    '''Filter one body through (position, rotation, valid) samples, return the outputs per frame.'''
+    outputs = []
+    for n, (position, rotation, valid) in enumerate(samples):
+        p, r, initialized = pose_filter.update((1,), [position], [rotation], [valid], (start + n) / RATE)
+        outputs.append((p[0].copy(), r[0].copy(), bool(initialized[0])))
+    return outputs
+
+def test_constant():
+    position, rotation = [0.25, 1.5, -0.75], z_rotation(40.0)
+    for method in METHODS:
+        outputs = run(Pose_Filter(method), [(position, rotation, True)] * 240)
+        for p, r, initialized in outputs:
+            assert initialized
+            assert np.allclose(p, position, rtol=0, atol=1e-12), (method, p)
+            assert angle(r, rotation) < 1e-4, (method, r)
+
+def test_constant_sign_flips():
+    # q and -q are the same rotation, flipping the sign must not move the estimate
+    rotation = z_rotation(40.0)
+    samples = [([0.0, 0.0, 0.0], rotation if n % 2 else [-v for v in rotation], True) for n in range(120)]
+    for p, r, initialized in run(Pose_Filter(), samples):
+        assert angle(r, rotation) < 1e-4, r
+
+def test_step():
+    before, after = [0.0, 1.0, 0.0], [0.1, 1.0, 0.0]
+    samples = [(before, z_rotation(0.0), True)] * 60 + [(after, z_rotation(30.0), True)] * 120
+    for method in METHODS:
+        outputs = run(Pose_Filter(method), samples)
+        assert np.allclose(outputs[59][0], before, atol=1e-12)
+        # The first filtered sample after the step lags behind, the last one has settled
+        p, r, initialized = outputs[60]
+        assert 0.0 < p[0] < 0.1 and angle(r, z_rotation(30.0)) > 1.0, (method, p, r)
+        p, r, initialized = outputs[-1]
+        assert np.allclose(p, after, atol=1e-4), (method, p)
+        assert angle(r, z_rotation(30.0)) < 0.1, (method, r)
+        # The constant velocity model of the Kalman filter overshoots a step a little
+        assert max(output[0][0] for output in outputs) < 0.1 * 1.2, method
+        # and both have settled to within 1 mm a quarter second after it
+        assert all(abs(output[0][0] - 0.1) < 1e-3 for output in outputs[90:]), method
+
+def test_gap():
+    old, new = [0.0, 1.0, 0.0], [0.5, 1.0, 0.0]
+    for method in METHODS:
+        pose_filter = Pose_Filter(method, max_gap=0.5)
+        run(pose_filter, [(old, z_rotation(0.0), True)] * 60)
+        # A gap shorter than max_gap keeps the state
+        outputs = run(pose_filter, [(new, z_rotation(90.0), False)] * 48, start=60)
+        assert all(initialized for p, r, initialized in outputs), method
+        assert np.allclose(outputs[-1][0], old, atol=1e-6), (method, outputs[-1][0])
+        # After max_gap it is dropped
+        outputs = run(pose_filter, [(new, z_rotation(90.0), False)] * 24, start=108)
+        assert not outputs[-1][2], method
+        # and restarts from the next valid sample instead of smoothing towards it
+        p, r, initialized = run(pose_filter, [(new, z_rotation(90.0), True)], start=132)[0]
+        assert initialized and np.allclose(p, new, atol=1e-12), (method, p)
+        assert angle(r, z_rotation(90.0)) < 1e-6, (method, r)
+
+def test_apply():
+    pose_filter = Pose_Filter()
+    bodies = [{'id': 1, 'position': (0.0, 1.0, 0.0), 'rotation': (0.0, 0.0, 0.0, 1.0), 'valid': True},
+              {'id': 2, 'position': (0.0, 0.0, 0.0), 'rotation': (0.0, 0.0, 0.0, 1.0), 'valid': False}]
+    pose_filter.apply(bodies, 0.0)
+    assert bodies[0]['filteredPosition'] == [0.0, 1.0, 0.0]
+    # A body that never was valid has no filtered pose
+    assert 'filteredPosition' not in bodies[1] and 'filteredRotation' not in bodies[1]
+    # and one that was dropped after max_gap loses it
+    bodies[0]['valid'] = False
+    pose_filter.apply(bodies, 1.0)
+    assert 'filteredPosition' not in bodies[0] and 'filteredRotation' not in bodies[0]
+
+if __name__ == '__main__':
+    test_constant()
+    test_constant_sign_flips()
+    test_step()
+    test_gap()
+    test_apply()
+    print( "filters ok" )
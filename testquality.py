@@ -0,0 +1,37 @@
+from quality import Quality_Monitor
+
+# Rolling metrics of rigid bodies that come and go. A body missing from a
+# frame keeps its last values in the frame, they must not be counted again.
+
+def make_frame(bodies, error=0.001):
+    return {'rigidBodies': [{'id': id, 'valid': True, 'markerError': error} for id in bodies]}
+
+def test_missing_bodies():
+    monitor = Quality_Monitor(window=1.0)
+    for n in range(100):
+        # Body 2 leaves after 10 frames but stays in the rigid body list
+        present = {1, 2} if n < 10 else {1}
+        monitor.add_frame(n / 100.0, make_frame([1, 2], 0.001 if n < 10 else 0.005), present)
+    assert monitor.bodies[1].frames == 100 and monitor.bodies[2].frames == 10
+    assert abs(monitor.bodies[2].marker_error.mean - 0.001) < 1e-12
+    # Its samples leave the window and nothing replaces them
+    monitor.expire(1.2)
+    assert monitor.bodies[2].marker_error.mean is None and len(monitor.bodies[2].valid) == 0
+    assert monitor.summary()['rigidBodies']['2']['frames'] == 10
+
+def test_window():
+    monitor = Quality_Monitor(window=1.0)
+    for n in range(300):
+        frame = make_frame([1], 0.001 if n < 200 else 0.003)
+        frame['rigidBodies'][0]['valid'] = n % 4 != 0
+        monitor.add_frame(n / 100.0, frame)
+    body = monitor.bodies[1]
+    # The last second holds the last 100 frames, give or take rounding, the invalid ones have no marker error
+    assert len(body.valid) in (100, 101) and abs(body.valid.mean - 0.75) < 0.01
+    assert body.marker_error.max == 0.003 and 0.0028 < body.marker_error.mean < 0.003 + 1e-12
+    assert ('markerError', '1', body.marker_error.mean) in monitor.check_alarms(2.99)
+
+if __name__ == '__main__':
+    test_missing_bodies()
+    test_window()
+    print( "quality ok" )
@@ -0,0 +1,86 @@
+import json
+
+from triggers import Ring_Buffer, Event_Recorder
+
+# The pre-trigger ring buffer and the frames written around events, at 100 Hz
+# with 0.1 s before and 0.2 s after each trigger.
+
+class List_Writer(object):
+    def __init__(self):
+        self.frames = []
+
+    def write(self, text):
+        self.frames.append(json.loads(text))
+
+def frame(n):
+    return n / 100.0, json.dumps({'time': n / 100.0})
+
+def written(writer):
+    return [round(obj['time'] * 100) for obj in writer.frames]
+
+def test_ring_buffer():
+    ring = Ring_Buffer(4)
+    assert ring.drain() == []
+    for n in range(10):
+        ring.append(n, n)
+    assert len(ring) == 4
+    assert ring.drain() == [6, 7, 8, 9] and len(ring) == 0
+    for n in range(3):
+        ring.append(n, n)
+    assert ring.drain(since=1) == [1, 2]
+    assert ring.drain() == []
+
+def test_pre_and_post_trigger():
+    writer = List_Writer()
+    recorder = Event_Recorder(writer, 0.1, 0.2, 100.0)
+    for n in range(100):
+        recorder.add(*frame(n))
+    recorder.trigger(1.0, 'a', 'test')
+    assert recorder.active
+    for n in range(100, 200):
+        recorder.add(*frame(n))
+    assert not recorder.active
+    # The ring holds a little more than pre_trigger, only the window is written
+    assert written(writer) == list(range(90, 121)), written(writer)
+    assert writer.frames[0]['events'] == [{'name': 'a', 'source': 'test', 'time': 1.0}]
+    assert all('events' not in obj for obj in writer.frames[1:])
+
+def test_back_to_back_triggers():
+    writer = List_Writer()
+    recorder = Event_Recorder(writer, 0.1, 0.2, 100.0)
+    for n in range(100):
+        recorder.add(*frame(n))
+    recorder.trigger(1.0, 'a', 'test')
+    for n in range(100, 105):
+        recorder.add(*frame(n))
+    # A trigger during an event extends it
+    recorder.trigger(1.05, 'b', 'test')
+    for n in range(105, 130):
+        recorder.add(*frame(n))
+    # One right after the event only gets the frames since it ended
+    recorder.trigger(1.3, 'c', 'test')
+    for n in range(130, 200):
+        recorder.add(*frame(n))
+    times = written(writer)
+    assert len(times) == len(set(times)), times
+    assert times == list(range(90, 151)), times
+    assert [event['name'] for obj in writer.frames for event in obj.get('events', ())] == ['a', 'b', 'c']
+    assert recorder.event_count == 3
+
+def test_frames_added_after_trigger():
+    # With gaze batches the frames before the trigger are only added after it
+    writer = List_Writer()
+    recorder = Event_Recorder(writer, 0.1, 0.2, 100.0)
+    for n in range(80):
+        recorder.add(*frame(n))
+    recorder.trigger(1.0, 'a', 'test')
+    for n in range(80, 200):
+        recorder.add(*frame(n))
+    assert written(writer) == list(range(90, 121)), written(writer)
+
+if __name__ == '__main__':
+    test_ring_buffer()
+    test_pre_and_post_trigger()
+    test_back_to_back_triggers()
+    test_frames_added_after_trigger()
+    print( "triggers ok" )
@@ -0,0 +1,78 @@
+from NatNetClient import NatNetClient
+from soak import pack_frame, pack_model_def
+
+# Unpacking of frames with subscriptions. Skipped rigid bodies, skeletons and
+# markers must be stepped over exactly, or everything after them is garbage.
+
+BODIES = [(1, 'head'), (2, 'hand'), (3, 'wand')]
+UNLABELED = [(0.1, 0.2, 0.3), (0.4, 0.5, 0.6)]
+LABELED = [(1.0, 1.5, 2.0), (2.5, 3.0, 3.5), (4.0, 4.5, 5.0)]
+TIMESTAMP = 12.25
+
+def rigid_body(id, markers):
+    return (id, (0.5 * id, 1.0, -0.25), (0.0, 0.0, 0.0, 1.0), [(0.01 * j, 0.5, 0.0) for j in range(markers)])
+
+def unpack(packet, **subscription):
+    client = NatNetClient()
+    frames = []
+    client.newFrameListener = lambda *values: frames.append(values)
+    client._NatNetClient__processMessage(pack_model_def(BODIES))
+    if subscription:
+        client.setSubscription(**subscription)
+    client._NatNetClient__processMessage(packet)
+    assert len(frames) == 1
+    return client, frames[0]
+
+def make_packet(skeletons=()):
+    # Different marker counts, so every body has a different size
+    return pack_frame(42, [rigid_body(1, 3), rigid_body(2, 0), rigid_body(3, 5)], UNLABELED, LABELED, TIMESTAMP,
+                      skeletons=skeletons)
+
+def check_trailer(values):
+    frameNumber, timestamp = values[0], values[9]
+    assert frameNumber == 42 and timestamp == TIMESTAMP, values
+
+def test_skip_rigid_bodies():
+    for ids in ([1], [2], [3], [1, 3], []):
+        client, values = unpack(make_packet(), rigidBodies=ids)
+        check_trailer(values)
+        bodies = client.getRigidBodyList()
+        assert [body['id'] for body in bodies] == ids
+        for body in bodies:
+            id, position, rotation, markers = rigid_body(body['id'], (3, 0, 5)[body['id'] - 1])
+            assert body['markerCount'] == len(markers) and body['valid']
+            assert all(abs(a - b) < 1e-6 for a, b in zip(body['position'], position)), body
+
+def test_skip_skeletons():
+    skeletons = [(7, [rigid_body(11, 2), rigid_body(12, 4)])]
+    client, values = unpack(make_packet(skeletons), skeletons=False)
+    check_trailer(values)
+    client, values = unpack(make_packet(skeletons), rigidBodies=[3], skeletons=False)
+    check_trailer(values)
+    assert client.getRigidBodyList()[0]['markerCount'] == 5
+
+def test_markers():
+    # Without a subscription only the unlabeled markers are kept
+    client, values = unpack(make_packet())
+    check_trailer(values)
+    assert [marker['labeled'] for marker in client.getMarkerList()] == [False, False]
+
+    client, values = unpack(make_packet(), markers=['labeled'])
+    check_trailer(values)
+    markers = client.getMarkerList()
+    assert [marker['id'] for marker in markers] == [1, 2, 3] and all(marker['labeled'] for marker in markers)
+    assert all(abs(a - b) < 1e-6 for marker, position in zip(markers, LABELED) for a, b in zip(marker['position'], position))
+
+    client, values = unpack(make_packet(), markers=['labeled', 'unlabeled'])
+    check_trailer(values)
+    assert len(client.getMarkerList()) == 5
+
+    client, values = unpack(make_packet(), markers=[])
+    check_trailer(values)
+    assert client.getMarkerList() == []
+
+if __name__ == '__main__':
+    test_skip_rigid_bodies()
+    test_skip_skeletons()
+    test_markers()
+    print( "unpack ok" )
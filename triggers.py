@@ -0,0 +1,96 @@
+'''
+Event-triggered full-rate recording.
+
+While the recorder writes decimated frames continuously, Event_Recorder
+keeps the last pre_trigger seconds of full-rate frames in a Ring_Buffer.
+When an event is triggered the buffered frames are written to a separate
+events recording, followed by every frame of the next post_trigger seconds.
+
+Frames are stored already serialized so the buffer holds a snapshot of each
+frame and nothing has to be serialized twice.
+'''
+
+import json
+
+class Ring_Buffer(object):
+    '''Fixed size buffer of (time, item) pairs overwriting the oldest entries.'''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = [0.0] * capacity
+        self.items = [None] * capacity
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, time, item):
+        end = (self.start + self.count) % self.capacity
+        self.times[end] = time
+        self.items[end] = item
+        if self.count < self.capacity:
+            self.count += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def drain(self, since=None):
+        '''Return the items newer than since, oldest first, and empty the buffer.'''
+        items = []
+        for i in range(self.count):
+            j = (self.start + i) % self.capacity
+            if since is None or self.times[j] >= since:
+                items.append(self.items[j])
+            self.items[j] = None
+        self.start = 0
+        self.count = 0
+        return items
+
+class Event_Recorder(object):
+    '''
+    Routes serialized full-rate frames either into the pre-trigger ring
+    buffer or, while an event is active, into writer (a
+    recording.Recording_Writer). The first frame written for an event gets an
+    "events" list naming what triggered it.
+    '''
+    def __init__(self, writer, pre_trigger, post_trigger, rate):
+        self.writer = writer
+        self.pre_trigger = pre_trigger
+        self.post_trigger = post_trigger
+        self.ring = Ring_Buffer(max(1, int(pre_trigger * rate) + 1))
+        self.active_from = None
+        self.active_until = None
+        self.pending = []
+        self.event_count = 0
+
+    @property
+    def active(self):
+        return self.active_until is not None
+
+    def trigger(self, time, name, source):
+        '''Start an event at time, or extend the active one.'''
+        self.pending.append({'name': name, 'source': source, 'time': time})
+        self.event_count += 1
+        if self.active_until is None:
+            self.active_from = time - self.pre_trigger
+            for text in self.ring.drain(self.active_from):
+                self._write(text)
+        self.active_until = max(self.active_until or time, time + self.post_trigger)
+
+    def add(self, time, text):
+        '''
+        Add the serialized frame captured at time. Frames can be added after
+        the trigger they precede, those from before the event's pre-trigger
+        window aren't written.
+        '''
+        if self.active_until is not None and time > self.active_until:
+            self.active_until = None
+        if self.active_until is None or time < self.active_from:
+            self.ring.append(time, text)
+        else:
+            self._write(text)
+
+    def _write(self, text):
+        if self.pending:
+            text = '{"events": %s, %s' % (json.dumps(self.pending), text[1:])
+            self.pending = []
+        self.writer.write(text)